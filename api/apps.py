@@ -6,5 +6,11 @@ class ApiConfig(AppConfig):
     name = 'api'
 
     def ready(self):
+        # noinspection PyUnresolvedReferences
+        from api import signals
         from api.helpers import SettingsHelper
         SettingsHelper.init()
+        from app.settings import API_ASYNC_VIEWS
+        if API_ASYNC_VIEWS:
+            from api.pool import AsyncTenantConnectionPool
+            AsyncTenantConnectionPool.check_available()
@@ -0,0 +1,51 @@
+"""
+Streaming responses for the async views. Django 4.0 iterates streaming
+responses synchronously on the event loop, APIASGIHandler sends
+AsyncStreamingHttpResponse with `async for` instead, so reading the
+content does not block other requests.
+"""
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.http import StreamingHttpResponse
+
+_END = object()
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+    streaming response with blocking content (e.g. rows read from the
+    database). Sent by APIASGIHandler every step runs in a worker thread,
+    a WSGI server iterates it as usual.
+    """
+
+    async def __aiter__(self):
+        step = sync_to_async(next, thread_sensitive=False)
+        while True:
+            part = await step(self._iterator, _END)
+            if part is _END:
+                return
+            yield self.make_bytes(part)
+
+
+class APIASGIHandler(ASGIHandler):
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        try:
+            await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+            async for part in response:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
@@ -0,0 +1,41 @@
+"""
+Views for the hot read paths when the project runs under ASGI (API_ASYNC_VIEWS).
+They answer from the in-process caches and the async connection pool without
+leaving the event loop, other requests go to the views in api/views.py.
+Serve them with app/asgi.py, its handler streams row exports without
+blocking the event loop.
+"""
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpResponseNotFound
+from rest_framework.exceptions import ValidationError
+
+from api import views
+from api.asgi import AsyncStreamingHttpResponse
+from api.helpers import DbHelper
+
+
+async def table_exists(request):
+    name = request.GET.get('name', None)
+    if not name:
+        return JsonResponse({'non_field_errors': {'name': 'please provide table name'}}, status=400)
+    return JsonResponse(await DbHelper.atable_exists(name), safe=False)
+
+
+async def read_rows(request, name):
+    table_data = await sync_to_async(DbHelper.get_table_data)(name)
+    if table_data is None:
+        return HttpResponseNotFound()
+    try:
+        query = views.build_row_query(table_data, request.GET)
+        if not views.is_page_request(request.GET):
+            content, content_type = views.build_row_export(table_data, query, request.GET)
+            # exports read through a server side cursor of the sync pool,
+            # every fetch runs in a worker thread (see api/asgi.py)
+            return AsyncStreamingHttpResponse(content, content_type=content_type)
+        page = views.build_row_page(query, request.GET)
+    except ValidationError as e:
+        return JsonResponse(e.detail, status=400)
+    sql, params = page.build_select()
+    rows = await DbHelper.afetchall_cached(table_data.get_name(), sql, params)
+    return JsonResponse(page.build_result(rows))
@@ -0,0 +1,252 @@
+import itertools
+import json
+import math
+import resource
+import statistics
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db.backends.signals import connection_created
+from django.test import Client
+
+from api.models import UserTokenDatabase
+from api.pool import connection_pool
+
+BENCHMARK_TABLE = 'bench_items'
+BENCHMARK_TABLE_FIELDS = {
+    'id': {'type': 'PrimaryKeyField', 'params': {}},
+    'name': {'type': 'CharField', 'params': {'length': 64, 'nullable': False, 'index': True}},
+    'active': {'type': 'BooleanField', 'params': {}},
+}
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class BenchmarkClient:
+    """
+    sends requests through the django stack in this process, or to a running
+    server when base_url is given. Returns (status, body).
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self._local = threading.local()
+
+    def request(self, method, path, token, body=None, content_type=None):
+        if self.base_url:
+            return self._request_http(method, path, token, body, content_type)
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = Client(HTTP_HOST='localhost')
+        kwargs = {'HTTP_AUTHORIZATION': token}
+        if body is not None:
+            kwargs['data'] = body
+            kwargs['content_type'] = content_type
+        response = client.generic(method, path, **kwargs)
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        return response.status_code, content
+
+    def _request_http(self, method, path, token, body, content_type):
+        headers = {'Authorization': token}
+        if content_type:
+            headers['Content-Type'] = content_type
+        data = body.encode() if isinstance(body, str) else body
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class ScenarioResult:
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.latencies = []
+        self.errors = 0
+        self.duration = 0.0
+        self.connections_opened = 0
+        self.peak_rss_kb = None
+
+    def to_dict(self):
+        latencies = sorted(self.latencies)
+        return {
+            'name': self.name,
+            'requests': len(latencies),
+            'errors': self.errors,
+            'concurrency': self.concurrency,
+            'duration_s': round(self.duration, 4),
+            'throughput_rps': round(len(latencies) / self.duration, 2) if self.duration else None,
+            'latency_ms': {
+                'p50': self._percentile(latencies, 50),
+                'p95': self._percentile(latencies, 95),
+                'p99': self._percentile(latencies, 99),
+                'mean': round(statistics.mean(latencies) * 1000, 3) if latencies else None,
+                'max': round(latencies[-1] * 1000, 3) if latencies else None,
+            },
+            'connections_opened': self.connections_opened,
+            'process_peak_rss_kb': self.peak_rss_kb,
+        }
+
+    @staticmethod
+    def _percentile(latencies, percent):
+        # nearest rank
+        if not latencies:
+            return None
+        index = max(math.ceil(percent / 100 * len(latencies)) - 1, 0)
+        return round(latencies[index] * 1000, 3)
+
+
+class Benchmark:
+    """
+    Drives the API hot paths for a number of tenants at a given concurrency.
+
+    Every tenant is provisioned like a signup and gets the bench_items table.
+    Scenarios run one after the other, each sends `requests` requests spread
+    round robin over the tenants. create_table requests are timed until their
+    schema job finished, so no job is left running into the next scenario.
+    process_peak_rss_kb is the peak of this process since it started, it is
+    only reported without base_url. Needs the configured Postgres server, the
+    hot paths use COPY and the postgres catalog.
+    """
+    SCENARIOS = ('create_table', 'table_exists', 'insert_rows', 'read_page', 'read_stream')
+
+    def __init__(self, tenants=10, requests=1000, concurrency=10, batch_size=100, base_url=None, scenarios=None):
+        self.tenants = tenants
+        self.requests = requests
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_url = base_url
+        self.scenarios = scenarios or self.SCENARIOS
+        self.client = BenchmarkClient(base_url)
+        self.tokens = []
+        self._ids = {}
+        self._django_connections = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        unknown = [name for name in self.scenarios if name not in self.SCENARIOS]
+        if unknown:
+            raise BenchmarkError(f'unknown scenarios: {", ".join(unknown)}')
+        if self.tenants < 1 or self.requests < 1 or self.concurrency < 1:
+            raise BenchmarkError('tenants, requests and concurrency must be at least 1')
+        self.setup()
+        return {
+            'commit': self._get_commit(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'config': {
+                'tenants': self.tenants,
+                'requests': self.requests,
+                'concurrency': self.concurrency,
+                'batch_size': self.batch_size,
+                'base_url': self.base_url,
+            },
+            'scenarios': [self.run_scenario(name).to_dict() for name in self.scenarios],
+        }
+
+    def setup(self):
+        tables = json.dumps({'tables': [{'name': BENCHMARK_TABLE, 'fields': BENCHMARK_TABLE_FIELDS}]})
+        for _ in range(self.tenants):
+            token, database = UserTokenDatabase.create_token_and_database()
+            status, body = self.client.request('POST', '/api/schema', token, tables, 'application/json')
+            if status != 202:
+                raise BenchmarkError(f'creating {BENCHMARK_TABLE} failed with {status}: {body[:200]}')
+            job_id = json.loads(body)['id']
+            status, body = self.client.request('GET', f'/api/schema-jobs/{job_id}?wait=30', token)
+            if status != 200 or json.loads(body)['status'] != 'succeeded':
+                raise BenchmarkError(f'creating {BENCHMARK_TABLE} failed: {body[:200]}')
+            self.tokens.append(token)
+            self._ids[token] = itertools.count(1)
+
+    def run_scenario(self, name):
+        build_request = getattr(self, f'_build_{name}')
+        complete = getattr(self, f'_complete_{name}', None)
+        result = ScenarioResult(name, self.concurrency)
+        lock = threading.Lock()
+
+        def send(i):
+            token = self.tokens[i % len(self.tokens)]
+            method, path, body, content_type = build_request(token, i)
+            started_at = time.perf_counter()
+            status, content = self.client.request(method, path, token, body, content_type)
+            if complete is not None and status < 400:
+                status = complete(token, content)
+            elapsed = time.perf_counter() - started_at
+            with lock:
+                result.latencies.append(elapsed)
+                if status >= 400:
+                    result.errors += 1
+
+        opened = connection_pool.opened
+        self._django_connections = 0
+        connection_created.connect(self._count_connection)
+        started_at = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                list(executor.map(send, range(self.requests)))
+        finally:
+            result.duration = time.perf_counter() - started_at
+            connection_created.disconnect(self._count_connection)
+        if not self.base_url:
+            result.connections_opened = connection_pool.opened - opened + self._django_connections
+            # in kilobytes on linux
+            result.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return result
+
+    # noinspection PyUnusedLocal
+    def _count_connection(self, sender, connection, **kwargs):
+        with self._lock:
+            self._django_connections += 1
+
+    # noinspection PyMethodMayBeStatic
+    def _build_create_table(self, token, i):
+        body = json.dumps({'name': f'bench_{i}', 'fields': BENCHMARK_TABLE_FIELDS})
+        return 'POST', '/api/create-table', body, 'application/json'
+
+    def _complete_create_table(self, token, content):
+        """
+        waits for the schema job, returns the status the request counts with
+        """
+        job_id = json.loads(content)['id']
+        status, content = self.client.request('GET', f'/api/schema-jobs/{job_id}?wait=30', token)
+        if status != 200:
+            return status
+        return 200 if json.loads(content)['status'] == 'succeeded' else 500
+
+    # noinspection PyMethodMayBeStatic
+    def _build_table_exists(self, token, i):
+        return 'GET', f'/api/table-exists?name={BENCHMARK_TABLE}', None, None
+
+    def _build_insert_rows(self, token, i):
+        ids = self._ids[token]
+        rows = [
+            json.dumps({'id': next(ids), 'name': f'item {i}', 'active': i % 2 == 0})
+            for _ in range(self.batch_size)
+        ]
+        return 'POST', f'/api/tables/{BENCHMARK_TABLE}/rows:bulk', '\n'.join(rows), 'application/x-ndjson'
+
+    # noinspection PyMethodMayBeStatic
+    def _build_read_page(self, token, i):
+        return 'GET', f'/api/tables/{BENCHMARK_TABLE}/rows?limit=100&order_by=name', None, None
+
+    # noinspection PyMethodMayBeStatic
+    def _build_read_stream(self, token, i):
+        return 'GET', f'/api/tables/{BENCHMARK_TABLE}/rows?row_format=ndjson', None, None
+
+    @staticmethod
+    def _get_commit():
+        # noinspection PyBroadException
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except Exception:
+            return None
@@ -0,0 +1,397 @@
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+
+from app.settings import TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, TOKEN_CACHE_BACKEND, MODEL_SOURCE_CACHE_SIZE, \
+    CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL, \
+    RESULT_CACHE_VERSION_BACKEND, TABLE_DATA_CACHE_SIZE
+
+_MISSING = object()
+
+# version key of a whole tenant database, bumped by writes the table of is unknown
+ALL_TABLES = '*'
+# version key of the table names of a tenant database, bumped by schema changes
+CATALOG = '#catalog'
+
+READ_QUERY_RE = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+
+
+class LRUCache:
+    """
+    Thread safe in-process LRU cache, entries optionally expire after ttl seconds.
+    With max_weight set, entries are also evicted while the summed weight
+    passed to set() is over it.
+    """
+
+    def __init__(self, max_size, ttl=None, max_weight=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            value, expires_at, weight = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, weight=1):
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (value, expires_at, weight)
+            self._weight += weight
+            while self._data and (len(self._data) > self.max_size or self._is_overweight()):
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            keys = [key for key, (value, _, _) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'weight': self._weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._weight -= item[2]
+
+    def _is_overweight(self):
+        return self.max_weight is not None and self._weight > self.max_weight
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TokenDatabaseCache:
+    """
+    token -> database lookups for APIMiddleware.
+
+    Lookups are answered from the shared cache configured with
+    TOKEN_CACHE_BACKEND, or from an in-process LRU cache without it, and
+    only then from the user_database table. Entries are invalidated by the
+    UserTokenDatabase signals in api/signals.py. The signals reach only the
+    in-process cache of the process changing the token, so it is not used
+    next to a shared cache.
+    """
+    _local = LRUCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+    @classmethod
+    def get_database(cls, token):
+        shared = cls._get_shared_cache()
+        if shared is None:
+            database = cls._local.get(token)
+        else:
+            database = shared.get(cls._get_shared_key(token))
+        if database is not None:
+            return database
+        database = cls._load(token)
+        if database is None:
+            return None
+        if shared is None:
+            cls._local.set(token, database)
+        else:
+            shared.set(cls._get_shared_key(token), database, TOKEN_CACHE_TTL)
+        return database
+
+    @classmethod
+    def get_cached_database(cls, token):
+        """
+        answers from the in-process cache only, None when the token is not
+        there or a shared cache is configured
+        """
+        if cls._get_shared_cache() is not None:
+            return None
+        return cls._local.get(token)
+
+    @classmethod
+    def invalidate(cls, token):
+        cls._local.delete(token)
+        shared = cls._get_shared_cache()
+        if shared is not None:
+            shared.delete(cls._get_shared_key(token))
+
+    @classmethod
+    def invalidate_database(cls, database):
+        cls._local.delete_where(lambda token, value: value == database)
+
+    @classmethod
+    def clear(cls):
+        cls._local.clear()
+
+    @staticmethod
+    def _load(token):
+        from api.models import UserTokenDatabase
+        return UserTokenDatabase.objects.filter(token=token).values_list('database', flat=True).first()
+
+    @staticmethod
+    def _get_shared_cache():
+        if not TOKEN_CACHE_BACKEND:
+            return None
+        return caches[TOKEN_CACHE_BACKEND]
+
+    @staticmethod
+    def _get_shared_key(token):
+        # tokens are 255 characters long, longer than some backends allow for keys
+        return 'token_database:%s' % hashlib.sha256(token.encode()).hexdigest()
+
+
+class ModelSourceCache:
+    """
+    generated model source keyed by (fingerprint of the table data, managed),
+    only tables whose data changed are rendered again when models.py is rebuilt
+    """
+    _local = LRUCache(MODEL_SOURCE_CACHE_SIZE)
+
+    @classmethod
+    def get(cls, key):
+        return cls._local.get(key)
+
+    @classmethod
+    def set(cls, key, source):
+        cls._local.set(key, source)
+
+
+class TableDataCache:
+    """
+    parsed TableData keyed by (database, table name, fingerprint), a schema
+    change gives the table a new fingerprint so entries never go stale
+    """
+    _local = LRUCache(TABLE_DATA_CACHE_SIZE)
+
+    @classmethod
+    def get(cls, database, name, fingerprint, load_table_data):
+        if not fingerprint:
+            return load_table_data()
+        key = (database, name, fingerprint)
+        table_data = cls._local.get(key)
+        if table_data is None:
+            table_data = load_table_data()
+            cls._local.set(key, table_data)
+        return table_data
+
+    @classmethod
+    def set(cls, database, table_data):
+        cls._local.set((database, table_data.get_name(), table_data.get_fingerprint()), table_data)
+
+
+class CatalogCache:
+    """
+    snapshot of the table names of every tenant database, loaded from the
+    catalog once and dropped when a schema change is applied. With
+    RESULT_CACHE_VERSION_BACKEND snapshots are tagged with a shared version,
+    a schema change applied by another process drops them as well.
+    """
+    _local = LRUCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+
+    @classmethod
+    def get_tables(cls, database, load_tables):
+        version = TableVersions.get(database, CATALOG) if TableVersions.is_shared() else None
+        cached = cls._local.get(database)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        tables = frozenset(load_tables())
+        cls._local.set(database, (version, tables))
+        return tables
+
+    @classmethod
+    async def aget_tables(cls, database, aload_tables):
+        version = await TableVersions.aget(database, CATALOG) if TableVersions.is_shared() else None
+        cached = cls._local.get(database)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        tables = frozenset(await aload_tables())
+        cls._local.set(database, (version, tables))
+        return tables
+
+    @classmethod
+    def invalidate(cls, database):
+        cls._local.delete(database)
+        if TableVersions.is_shared():
+            TableVersions.bump(database, CATALOG)
+
+
+class TableVersions:
+    """
+    version of every tenant table, replaced by each write and schema change.
+    Kept in the cache configured with RESULT_CACHE_VERSION_BACKEND so every
+    worker process sees the same versions, in memory without it.
+
+    Versions are random, a version the shared cache lost (evicted, restarted)
+    is replaced by a new one and never matches results read before.
+    """
+    _local = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, database, table):
+        shared = cls._get_shared_cache()
+        if shared is not None:
+            return shared.get_or_set(cls._get_shared_key(database, table), cls._new_version, None)
+        with cls._lock:
+            return cls._local.setdefault((database, table), cls._new_version())
+
+    @classmethod
+    async def aget(cls, database, table):
+        if cls._get_shared_cache() is not None:
+            return await sync_to_async(cls.get)(database, table)
+        return cls.get(database, table)
+
+    @classmethod
+    def bump(cls, database, table):
+        version = cls._new_version()
+        shared = cls._get_shared_cache()
+        if shared is not None:
+            shared.set(cls._get_shared_key(database, table), version, None)
+        else:
+            with cls._lock:
+                cls._local[(database, table)] = version
+        return version
+
+    @classmethod
+    async def abump(cls, database, table):
+        if cls._get_shared_cache() is not None:
+            return await sync_to_async(cls.bump)(database, table)
+        return cls.bump(database, table)
+
+    @classmethod
+    def is_shared(cls):
+        return cls._get_shared_cache() is not None
+
+    @staticmethod
+    def _get_shared_cache():
+        if not RESULT_CACHE_VERSION_BACKEND:
+            return None
+        return caches[RESULT_CACHE_VERSION_BACKEND]
+
+    @staticmethod
+    def _get_shared_key(database, table):
+        return f'table_version:{database}:{table}'
+
+    @staticmethod
+    def _new_version():
+        return uuid.uuid4().hex
+
+
+class QueryResultCache:
+    """
+    results of read queries keyed by (database, table, sql, params) and
+    tagged with the versions of the table and its database they were read
+    at, a result is served only while both are unchanged.
+
+    Enabled only with RESULT_CACHE_VERSION_BACKEND, versions kept in one
+    process would miss the writes of the others.
+    """
+    _local = LRUCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL, RESULT_CACHE_MAX_BYTES)
+    _lock = threading.Lock()
+    _hits = 0
+    _misses = 0
+
+    @staticmethod
+    def is_enabled():
+        return bool(RESULT_CACHE_VERSION_BACKEND)
+
+    @staticmethod
+    def is_read(sql):
+        return isinstance(sql, str) and READ_QUERY_RE.match(sql) is not None
+
+    @classmethod
+    def get_or_load(cls, database, table, sql, params, load):
+        if not cls.is_enabled():
+            return load()
+        key = (database, table, sql, tuple(params or ()))
+        # the version is read before the query runs, a write that happens
+        # meanwhile makes the stored result stale right away
+        version = (TableVersions.get(database, ALL_TABLES), TableVersions.get(database, table))
+        cached = cls._local.get(key)
+        if cached is not None and cached[0] == version:
+            cls._count(hit=True)
+            return cached[1]
+        cls._count(hit=False)
+        result = load()
+        cls._local.set(key, (version, result), weight=len(repr(result)))
+        return result
+
+    @classmethod
+    async def aget_or_load(cls, database, table, sql, params, aload):
+        if not cls.is_enabled():
+            return await aload()
+        key = (database, table, sql, tuple(params or ()))
+        version = (await TableVersions.aget(database, ALL_TABLES), await TableVersions.aget(database, table))
+        cached = cls._local.get(key)
+        if cached is not None and cached[0] == version:
+            cls._count(hit=True)
+            return cached[1]
+        cls._count(hit=False)
+        result = await aload()
+        cls._local.set(key, (version, result), weight=len(repr(result)))
+        return result
+
+    @classmethod
+    def invalidate(cls, database, table=None):
+        """
+        drops the results of the table, of every table of the database without it
+        """
+        if cls.is_enabled():
+            TableVersions.bump(database, table or ALL_TABLES)
+
+    @classmethod
+    async def ainvalidate(cls, database, table=None):
+        if cls.is_enabled():
+            await TableVersions.abump(database, table or ALL_TABLES)
+
+    @classmethod
+    def stats(cls):
+        stats = cls._local.stats()
+        stats['hits'] = cls._hits
+        stats['misses'] = cls._misses
+        return stats
+
+    @classmethod
+    def _count(cls, hit):
+        with cls._lock:
+            if hit:
+                cls._hits += 1
+            else:
+                cls._misses += 1
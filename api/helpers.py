@@ -1,21 +1,34 @@
-import itertools
 import json
+import keyword
+import logging
 import os
-import subprocess
+import re
+import stat
+import tempfile
+import uuid
+from contextlib import contextmanager
 from abc import abstractmethod
-from collections import OrderedDict
 
-import psycopg2
-from django.apps import apps
 from django.core import management
 from django.core.management import call_command
 from django.db import transaction
 
+from api.cache import ModelSourceCache, CatalogCache, QueryResultCache, TableDataCache
+from api.metrics import Metrics
 from api.middleware import get_user_database, get_user_token
+from api.migrator import MigrationEngine
 from api.models import UserTable
-from app import settings
-from app.settings import MAIN_DATABASE, MAIN_DATABASE_USER, MAIN_DATABASE_PASSWORD, MAIN_DATABASE_HOST, \
-    MAIN_DATABASE_PORT
+from api.pool import connection_pool, async_connection_pool
+from api.provisioning import ProvisioningRegistry
+from api.registry import TenantAppRegistry, TenantConnectionRegistry
+from api.rows import BulkRowLoader
+from api.schema import SchemaDiff, SCHEMA_BACKEND_MIGRATIONS
+from api.tenancy import TenantStorage
+from api.utils import UtilHelper
+from app.settings import USER_SCHEMA_BACKEND, SCHEMA_BATCH_MAX_TABLES, \
+    TENANT_APPS_EAGER_LOAD, ROW_EXPORT_FETCH_SIZE
+
+logger = logging.getLogger(__name__)
 
 
 class UserDatabaseHelper:
@@ -24,60 +37,105 @@ class UserDatabaseHelper:
         return '__frontend_database__%s' % name
 
     @staticmethod
-    def prepare_environment():
-        user_database = get_user_database()
-        conn = psycopg2.connect(
-            database=MAIN_DATABASE,
-            user=MAIN_DATABASE_USER,
-            password=MAIN_DATABASE_PASSWORD,
-            host=MAIN_DATABASE_HOST,
-            port=MAIN_DATABASE_PORT,
-        )
-        conn.autocommit = True
-        cursor = conn.cursor()
-        # noinspection PyBroadException
-        try:
-            # noinspection SqlDialectInspection
-            cursor.execute(f'CREATE DATABASE {user_database}')
-        except Exception as e:
-            # database already exists
-            pass
-        conn.close()
+    def prepare_environment(database=None):
+        if not database:
+            database = get_user_database()
+        ProvisioningRegistry.ensure(database)
+
+    @staticmethod
+    def connection():
+        return connection_pool.connection(*TenantStorage.get_location(get_user_database()))
 
     # noinspection PyShadowingNames
     @staticmethod
-    def execute(sql, fetchone=False, fetchall=False):
-        user_database = get_user_database()
-        conn = psycopg2.connect(
-            database=user_database,
-            user=MAIN_DATABASE_USER,
-            password=MAIN_DATABASE_PASSWORD,
-            host=MAIN_DATABASE_HOST,
-            port=MAIN_DATABASE_PORT,
-        )
-        conn.autocommit = True
-        cursor = conn.cursor()
-        # noinspection PyBroadException
+    def execute(sql, params=None, fetchone=False, fetchall=False, table=None):
+        """
+        table: name the query is recorded under in api/metrics.py, anything but
+        a SELECT drops the cached reads of it (of every table without it)
+        """
         try:
-            cursor.execute(sql)
-            result = None
-            if fetchone:
-                result = cursor.fetchone()
-            elif fetchall:
-                result = cursor.fetchall()
-            cursor.close()
-            return result
-        except Exception as e:
-            cursor.close()
-            raise e
+            with Metrics.time_query(get_user_database(), table) as record:
+                with UserDatabaseHelper.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(sql, params)
+                        record.rows = cursor.rowcount
+                        result = None
+                        if fetchone:
+                            result = cursor.fetchone()
+                        elif fetchall:
+                            result = cursor.fetchall()
+                        return result
+        finally:
+            if not QueryResultCache.is_read(sql):
+                QueryResultCache.invalidate(get_user_database(), table)
 
     @staticmethod
-    def fetchone(sql):
-        return UserDatabaseHelper.execute(sql, fetchone=True)
+    async def aexecute(sql, params=None, fetchone=False, fetchall=False, table=None):
+        try:
+            with Metrics.time_query(get_user_database(), table) as record:
+                async with async_connection_pool.connection(*TenantStorage.get_location(get_user_database())) as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(sql, params)
+                        record.rows = cursor.rowcount
+                        result = None
+                        if fetchone:
+                            result = await cursor.fetchone()
+                        elif fetchall:
+                            result = await cursor.fetchall()
+                        return result
+        finally:
+            if not QueryResultCache.is_read(sql):
+                await QueryResultCache.ainvalidate(get_user_database(), table)
 
     @staticmethod
-    def fetchall(sql):
-        return UserDatabaseHelper.execute(sql, fetchall=True)
+    def fetchone(sql, params=None, table=None):
+        return UserDatabaseHelper.execute(sql, params, fetchone=True, table=table)
+
+    @staticmethod
+    def fetchall(sql, params=None, table=None):
+        return UserDatabaseHelper.execute(sql, params, fetchall=True, table=table)
+
+    @staticmethod
+    async def afetchall(sql, params=None, table=None):
+        return await UserDatabaseHelper.aexecute(sql, params, fetchall=True, table=table)
+
+    @staticmethod
+    def fetchall_cached(table, sql, params=None):
+        """
+        fetchall for reads of a single table, repeated reads are served from
+        QueryResultCache until the table is written to or changed
+        """
+        return QueryResultCache.get_or_load(
+            get_user_database(), table, sql, params,
+            lambda: UserDatabaseHelper.fetchall(sql, params, table),
+        )
+
+    @staticmethod
+    def get_existing_tables():
+        rows = UserDatabaseHelper.fetchall(EXISTING_TABLES_SQL)
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def table_exists(name):
+        tables = CatalogCache.get_tables(get_user_database(), UserDatabaseHelper.get_existing_tables)
+        return UtilHelper.fold_identifier(name) in tables
+
+    @staticmethod
+    async def afetchall_cached(table, sql, params=None):
+        return await QueryResultCache.aget_or_load(
+            get_user_database(), table, sql, params,
+            lambda: UserDatabaseHelper.afetchall(sql, params, table),
+        )
+
+    @staticmethod
+    async def aget_existing_tables():
+        rows = await UserDatabaseHelper.afetchall(EXISTING_TABLES_SQL)
+        return [row[0] for row in rows]
+
+    @staticmethod
+    async def atable_exists(name):
+        tables = await CatalogCache.aget_tables(get_user_database(), UserDatabaseHelper.aget_existing_tables)
+        return UtilHelper.fold_identifier(name) in tables
 
     @staticmethod
     def get_user_models_file(app_path=None):
@@ -133,6 +191,7 @@ class UserDatabaseHelper:
                 # create migrations file
                 files_to_create = [
                     'migrations',
+                    'migrations/__init__.py',
                     '__init__.py',
                     'models.py',
                 ]
@@ -148,8 +207,56 @@ class UserDatabaseHelper:
 
     @staticmethod
     def build_table_from_data(data):
+        """
+        table and field names end up in models.py and in DDL, accept identifiers
+        only that are valid python and django names as well
+        """
+        if not isinstance(data, dict):
+            raise TableDataError('table must be an object with name and fields')
+        if not isinstance(data.get('fields'), dict):
+            raise TableDataError(f'fields of {data.get("name")} must be an object')
+        names = [data.get('name'), *data['fields']]
+        for name in names:
+            if not isinstance(name, str) or not IDENTIFIER_RE.match(name):
+                raise TableDataError(f'invalid name: {name}')
+        # the model class is named after the capitalized table name
+        if keyword.iskeyword(data['name'].capitalize()):
+            raise TableDataError(f'invalid name: {data["name"]}')
+        for name in data['fields']:
+            if keyword.iskeyword(name) or name in RESERVED_FIELD_NAMES or '__' in name or name.endswith('_'):
+                raise TableDataError(f'invalid field name: {name}')
+        UserDatabaseHelper.validate_indexes(data)
         return TableData(data)
 
+    @staticmethod
+    def validate_indexes(data):
+        indexes = data.get('indexes')
+        if indexes is None:
+            return
+        if not isinstance(indexes, list):
+            raise TableDataError(f'indexes of {data["name"]} must be a list')
+        for index in indexes:
+            fields = index.get('fields') if isinstance(index, dict) else None
+            if not isinstance(fields, list) or not fields or not all(isinstance(field, str) for field in fields):
+                raise TableDataError(f'indexes of {data["name"]} need a list of fields')
+            unknown = [field for field in fields if field not in data['fields']]
+            if unknown:
+                raise TableDataError(f'unknown index fields of {data["name"]}: {unknown}')
+            if len(set(fields)) != len(fields):
+                raise TableDataError(f'index fields of {data["name"]} repeat: {fields}')
+
+    @staticmethod
+    def build_tables_from_data(tables):
+        if len(tables) > SCHEMA_BATCH_MAX_TABLES:
+            raise TableDataError(f'at most {SCHEMA_BATCH_MAX_TABLES} tables can be changed at once')
+        tables_data = [UserDatabaseHelper.build_table_from_data(table) for table in tables]
+        names = set()
+        for table_data in tables_data:
+            if table_data.get_name() in names:
+                raise TableDataError(f'table {table_data.get_name()} is defined more than once')
+            names.add(table_data.get_name())
+        return tables_data
+
     @staticmethod
     def read_file(path):
         content = ''
@@ -157,56 +264,302 @@ class UserDatabaseHelper:
             content = file.read()
         return content
 
+    @staticmethod
+    @contextmanager
+    def transaction(table=None):
+        """
+        cursor of a pooled tenant connection, committed when the block
+        finishes and rolled back when it raises. Cached reads of `table`
+        (of every table without it) are dropped afterwards.
+        """
+        try:
+            with UserDatabaseHelper.connection() as conn:
+                conn.autocommit = False
+                with conn:
+                    with conn.cursor() as cursor:
+                        yield cursor
+        finally:
+            QueryResultCache.invalidate(get_user_database(), table)
+
+    @staticmethod
+    def execute_in_transaction(statements):
+        with Metrics.time_query(get_user_database()):
+            with UserDatabaseHelper.transaction() as cursor:
+                for sql, params in statements:
+                    cursor.execute(sql, params or None)
+
+    @staticmethod
+    def iter_rows(sql, params=None, fetch_size=ROW_EXPORT_FETCH_SIZE, table=None):
+        """
+        yields the rows of a query through a server side cursor, fetch_size rows
+        are held in memory at a time. The tenant is resolved right away, rows are
+        usually read after the view has returned.
+        """
+        return UserDatabaseHelper._iter_rows(get_user_database(), sql, params, fetch_size, table)
+
+    @staticmethod
+    def _iter_rows(database, sql, params, fetch_size, table):
+        with Metrics.time_query(database, table) as record:
+            with connection_pool.connection(*TenantStorage.get_location(database)) as conn:
+                # named cursors only live inside a transaction
+                conn.autocommit = False
+                try:
+                    with conn.cursor(name=f'rows_{uuid.uuid4().hex}') as cursor:
+                        cursor.itersize = fetch_size
+                        cursor.execute(sql, params or None)
+                        for row in cursor:
+                            record.rows += 1
+                            yield row
+                finally:
+                    conn.rollback()
+
+    @staticmethod
+    def get_table_data(name):
+        row = UserTable.objects.filter(name=name).values_list('data', 'fingerprint').first()
+        if not row:
+            return None
+        data, fingerprint = row
+        return UserDatabaseHelper.load_table_data(get_user_database(), name, data, fingerprint)
+
+    @staticmethod
+    def load_table_data(database, name, data, fingerprint):
+        return TableDataCache.get(database, name, fingerprint, lambda: TableData.from_json(data))
+
+    @staticmethod
+    def insert_rows(table_data, rows):
+        """
+        rows: iterable of (row dict, parse error) pairs, see RowReader
+        """
+        with Metrics.time_query(get_user_database(), table_data.get_name()) as record:
+            with UserDatabaseHelper.transaction(table_data.get_name()) as cursor:
+                result = BulkRowLoader(table_data).load(cursor, rows)
+            record.rows = result['accepted']
+            return result
+
+    @staticmethod
+    def is_managed_by_migrations():
+        return USER_SCHEMA_BACKEND == SCHEMA_BACKEND_MIGRATIONS
+
+    @staticmethod
+    def check_unique_indexes(changes):
+        """
+        rejects the changes before anything runs when the rows of a table
+        repeat values of a unique index the changes add to it
+        """
+        for saved_table_data, received_table_data in changes:
+            for index, sql, params in SchemaDiff(saved_table_data, received_table_data).get_unique_checks():
+                if UserDatabaseHelper.fetchone(sql, params, table=received_table_data.get_name()):
+                    raise TableDataError(
+                        f'unique index on {", ".join(index.fields)} of {received_table_data.get_name()} '
+                        f'can not be built, rows of the table repeat its values'
+                    )
+
+    @staticmethod
+    def apply_schema_changes(changes):
+        """
+        changes: [(saved_table_data or None, received_table_data), ...]
+        applied with one migration run or one DDL transaction, returns the
+        statements and the (dropped, created) indexes left for apply_index_changes
+        """
+        if UserDatabaseHelper.is_managed_by_migrations():
+            return UserDatabaseHelper.create_and_run_migrations(), ([], [])
+        statements = []
+        dropped_indexes = []
+        created_indexes = []
+        for saved_table_data, received_table_data in changes:
+            diff = SchemaDiff(saved_table_data, received_table_data)
+            statements.extend(diff.get_statements())
+            dropped, created = diff.get_index_changes()
+            dropped_indexes.extend(dropped)
+            created_indexes.extend(created)
+        UserDatabaseHelper.execute_in_transaction(statements)
+        return statements, (dropped_indexes, created_indexes)
+
+    @staticmethod
+    def apply_index_changes(dropped, created):
+        """
+        runs outside of a transaction, one index at a time, after the table
+        changes were committed. Returns the statements and the (index, error)
+        pairs of the indexes that failed. An index that fails to build is left
+        INVALID by postgres and dropped again, so a later attempt builds it
+        from scratch.
+        """
+        statements = []
+        failed = []
+        for index in dropped:
+            statements.append((index.build_drop(), []))
+            try:
+                UserDatabaseHelper.execute(index.build_drop())
+            except Exception as e:
+                failed.append((index, e))
+        for index in created:
+            statements.append((index.build_create(), []))
+            try:
+                UserDatabaseHelper.execute(index.build_create())
+            except Exception as e:
+                failed.append((index, e))
+                try:
+                    UserDatabaseHelper.execute(index.build_drop())
+                except Exception:
+                    logger.exception('dropping the failed index %s failed', index.name)
+        return statements, failed
+
+    @staticmethod
+    def forget_failed_indexes(database, changes, failed):
+        """
+        saves the tables without the indexes that failed to build, so the saved
+        tables match the tenant database and sending them again retries the build
+        """
+        names = {index.name for index, _ in failed}
+        table_models = []
+        for _, received_table_data in changes:
+            if not any(index.name in names for index in received_table_data.get_indexes()):
+                continue
+            table_data = received_table_data.without_indexes(names)
+            table_model = UserTable.objects.get(name=table_data.get_name())
+            table_model.data = table_data.to_json()
+            table_model.fingerprint = table_data.get_fingerprint()
+            table_models.append(table_model)
+            TableDataCache.set(database, table_data)
+        if not table_models:
+            return
+        with transaction.atomic():
+            UserTable.objects.bulk_update(table_models, ['data', 'fingerprint'])
+            UserDatabaseHelper.build_and_write_user_models_file()
+
     @staticmethod
     def create_and_run_migrations():
         db = get_user_database()
-        command_one = subprocess.Popen(['python', 'manage.py', 'makemigrations', db])
-        command_two = subprocess.Popen(['python', 'manage.py', 'migrate', db, f'--database={db}'])
+        return MigrationEngine.run(db, db)
+
+    @staticmethod
+    def create_table(name, fields, indexes=None):
+        table = {'name': name, 'fields': fields}
+        if indexes is not None:
+            table['indexes'] = indexes
+        return UserDatabaseHelper.create_tables([table])
 
     @staticmethod
-    def create_table(name, fields):
+    def create_tables(tables):
+        """
+        tables: [{'name': 'users', 'fields': {...}}, ...]
+        all tables are validated before anything is saved, changed tables are
+        saved together and reach the tenant database as one change
+        """
         db = get_user_database()
         UserDatabaseHelper.add_app_if_not_exists(db)
-        received_table_data = UserDatabaseHelper.build_table_from_data({'name': name, 'fields': fields})
-        existing_table_model = UserTable.objects.filter(name=name).first()
-        if not existing_table_model:
-            try:
-                with transaction.atomic():
-                    table_model = UserTable(name=name, data=received_table_data.to_json())
-                    table_model.save()
-                    UserDatabaseHelper.build_and_write_user_models_file()
-                    UserDatabaseHelper.create_and_run_migrations()
-            except Exception as e:
-                raise e
-        else:
-            saved_table_data = TableData.from_json(existing_table_model.data)
-            if received_table_data != saved_table_data:
-                try:
-                    with transaction.atomic():
-                        existing_table_model.data = received_table_data.to_json()
-                        existing_table_model.save()
-                        UserDatabaseHelper.build_and_write_user_models_file()
-                        UserDatabaseHelper.create_and_run_migrations()
-                except Exception as e:
-                    raise e
+        received_tables_data = UserDatabaseHelper.build_tables_from_data(tables)
+        names = [table_data.get_name() for table_data in received_tables_data]
+        table_models = {table_model.name: table_model for table_model in UserTable.objects.filter(name__in=names)}
+        new_table_models = []
+        changed_table_models = []
+        backfilled_table_models = []
+        changes = []
+        for received_table_data in received_tables_data:
+            table_model = table_models.get(received_table_data.get_name())
+            saved_table_data = None
+            if table_model:
+                if table_model.fingerprint == received_table_data.get_fingerprint():
+                    continue
+                saved_table_data = UserDatabaseHelper.load_table_data(
+                    db, table_model.name, table_model.data, table_model.fingerprint
+                )
+                if not table_model.fingerprint:
+                    table_model.fingerprint = saved_table_data.get_fingerprint()
+                    if received_table_data == saved_table_data:
+                        backfilled_table_models.append(table_model)
+                        continue
+                changed_table_models.append(table_model)
+            else:
+                table_model = UserTable(database=db, name=received_table_data.get_name())
+                new_table_models.append(table_model)
+            table_model.data = received_table_data.to_json()
+            table_model.fingerprint = received_table_data.get_fingerprint()
+            TableDataCache.set(db, received_table_data)
+            changes.append((saved_table_data, received_table_data))
+        if backfilled_table_models:
+            UserTable.objects.bulk_update(backfilled_table_models, ['fingerprint'])
+        if not changes:
+            return None
+        UserDatabaseHelper.check_unique_indexes(changes)
+        try:
+            with transaction.atomic():
+                UserTable.objects.bulk_create(new_table_models)
+                UserTable.objects.bulk_update(changed_table_models, ['data', 'fingerprint'])
+                UserDatabaseHelper.build_and_write_user_models_file()
+                result, (dropped, created) = UserDatabaseHelper.apply_schema_changes(changes)
+            if not dropped and not created:
+                return result
+            # the table changes are committed on both sides, a failed index
+            # build must not roll back the saved tables
+            index_statements, failed = UserDatabaseHelper.apply_index_changes(dropped, created)
+            if failed:
+                UserDatabaseHelper.forget_failed_indexes(db, changes, failed)
+                raise IndexBuildError('tables were changed, indexes failed: ' + '; '.join(
+                    f'{index.name} on {index.table} ({", ".join(index.fields)}): {e}' for index, e in failed
+                ))
+            return result + index_statements
+        finally:
+            CatalogCache.invalidate(db)
+            for _, received_table_data in changes:
+                QueryResultCache.invalidate(db, received_table_data.get_name())
 
     @staticmethod
     def write_to_user_models_file(content, models_file=None):
+        """
+        writes through a temporary file so readers never see a half written models.py,
+        an unchanged file is left alone to keep autoreloaders and makemigrations quiet
+        """
         if not models_file:
             models_file = UserDatabaseHelper.get_user_models_file()
-        with open(models_file, 'w') as file:
-            file.write(content)
+        if os.path.isfile(models_file) and UserDatabaseHelper.read_file(models_file) == content:
+            return False
+        try:
+            mode = stat.S_IMODE(os.stat(models_file).st_mode)
+        except FileNotFoundError:
+            mode = 0o644
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(models_file), prefix='.models.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(content)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, models_file)
+        except Exception as e:
+            os.unlink(tmp_path)
+            raise e
+        return True
+
+    @staticmethod
+    def build_user_model_source(data, managed, fingerprint=None):
+        key = (fingerprint or UtilHelper.get_fingerprint(data), managed)
+        source = ModelSourceCache.get(key)
+        if source is None:
+            source = TableData.from_json(data).build_to_write(managed)
+            ModelSourceCache.set(key, source)
+        return source
 
     @staticmethod
     def build_and_write_user_models_file():
-        user_table_models = UserTable.objects.all()
-        table_models = [TableData.from_json(model.data) for model in user_table_models]
+        managed = UserDatabaseHelper.is_managed_by_migrations()
+        user_tables = UserTable.objects.order_by('id').values_list('data', 'fingerprint')
         content_list = [
             'from django.db import models\n\n\n',
-            *[model.build_to_write() + '\n\n' for model in table_models]
+            *[
+                UserDatabaseHelper.build_user_model_source(data, managed, fingerprint) + '\n\n'
+                for data, fingerprint in user_tables
+            ]
         ]
         content = ''.join(content_list)
-        UserDatabaseHelper.write_to_user_models_file(content)
+        return UserDatabaseHelper.write_to_user_models_file(content)
+
+
+class TableDataError(Exception):
+    pass
+
+
+class IndexBuildError(Exception):
+    pass
 
 
 class TableData:
@@ -224,45 +577,96 @@ class TableData:
                     'length': 255,
                     'nullable': True,
                     'default_value': '',
+                    'unique': True,
                 }
             }
-        }
+        },
+        'indexes': [
+            {'fields': ['username', 'id'], 'unique': False}
+        ]
     }
     """
 
+    __slots__ = ('name', '_fields', '_indexes', '_fingerprint')
+
     def __init__(self, data):
-        self.name = data['name']
-        self._fields = []
-        self._fields_sorted = False
-        self._orig_fields = data['fields']
-        self.build_fields(data['fields'])
+        object.__setattr__(self, 'name', data['name'])
+        object.__setattr__(self, '_fields', self.build_fields(data['fields']))
+        object.__setattr__(self, '_indexes', tuple(
+            TableIndex(self.name, config['fields'], config.get('unique', False) is True)
+            for config in data.get('indexes') or ()
+        ))
+        object.__setattr__(self, '_fingerprint', None)
 
     def get_name(self) -> str:
         return self.name
 
     def get_fields(self):
-        self._sort_fields()
+        """
+        fields ordered by name
+        """
         return self._fields
 
-    def _sort_fields(self):
-        if self._fields_sorted is False:
-            self._fields.sort(key=lambda f: f.name)
-            self._fields_sorted = True
+    @staticmethod
+    def build_fields(fields):
+        return tuple(sorted(
+            (TableFieldFactory.create(name, config['type'], config['params']) for name, config in fields.items()),
+            key=lambda field: field.name,
+        ))
 
-    def build_fields(self, fields):
-        for name in fields:
-            config = fields[name]
-            type = config['type']
-            params = config['params']
-            field_class = TableFieldFactory.create(name, type, params)
-            self._fields.append(field_class)
-        self._sort_fields()
+    def get_indexes(self):
+        """
+        indexes declared by field params followed by the table level ones
+        """
+        indexes = {}
+        for field in self.get_fields():
+            if field.index or field.unique:
+                index = TableIndex(self.name, [field.name], field.unique)
+                indexes[index.name] = index
+        for index in self._indexes:
+            indexes.setdefault(index.name, index)
+        return list(indexes.values())
+
+    def without_indexes(self, names):
+        """
+        copy of the table without the indexes of the given names
+        """
+        data = json.loads(self.to_json())
+        for field in self.get_fields():
+            if (field.index or field.unique) and TableIndex(self.name, [field.name], field.unique).name in names:
+                params = data['fields'][field.name]['params']
+                params.pop('index', None)
+                params.pop('unique', None)
+        indexes = [index.to_dict() for index in self._indexes if index.name not in names]
+        if indexes:
+            data['indexes'] = indexes
+        else:
+            data.pop('indexes', None)
+        return TableData(data)
 
     def to_json(self):
         fields_dict = {}
         for field in self.get_fields():
             fields_dict[field.name] = field.to_dict()
-        return json.dumps({'name': self.name, 'fields': fields_dict})
+        data = {'name': self.name, 'fields': fields_dict}
+        if self._indexes:
+            data['indexes'] = [index.to_dict() for index in self._indexes]
+        return json.dumps(data)
+
+    def get_fingerprint(self):
+        """
+        sha256 of the canonical form of the table (sorted keys, params after the
+        field classes applied their defaults), equal fingerprints mean equal tables
+        """
+        if self._fingerprint is None:
+            data = {
+                'name': self.name,
+                'fields': [[field.name, field.get_type(), field.get_params()] for field in self.get_fields()],
+            }
+            if self._indexes:
+                data['indexes'] = [index.to_dict() for index in self._indexes]
+            object.__setattr__(self, '_fingerprint', UtilHelper.get_fingerprint(data))
+        return self._fingerprint
 
     @staticmethod
     def from_json(json_data):
@@ -276,13 +680,14 @@ class TableData:
                         ...
                     }
                 }
-            }
+            },
+            'indexes': [...]
         }
         """
         data = json.loads(json_data)
         return TableData(data)
 
-    def build_to_write(self):
+    def build_to_write(self, managed=True):
         content_list = [
             f"class {self.get_name().capitalize()}(models.Model):",
             *['    ' + field.build_to_write() for field in self.get_fields()],
@@ -290,38 +695,99 @@ class TableData:
             f'    class Meta:',
             f'        db_table = "{self.get_name()}"'
         ]
+        if not managed:
+            content_list.append('        managed = False')
+        indexes = [index.build_to_write() for index in self._indexes if not index.unique]
+        if indexes:
+            content_list.append(f'        indexes = [{", ".join(indexes)}]')
+        constraints = [index.build_to_write() for index in self._indexes if index.unique]
+        if constraints:
+            content_list.append(f'        constraints = [{", ".join(constraints)}]')
         return '\n'.join(content_list)
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
 
-        if self.get_name() != other.get_name():
-            return False
+        return self.get_fingerprint() == other.get_fingerprint()
 
-        self_fields = self.get_fields()
-        other_fields = other.get_fields()
-        for self_field, other_field in itertools.zip_longest(self_fields, other_fields, fillvalue=None):
-            if self_field != other_field:
-                return False
+    def __hash__(self):
+        return hash(self.get_fingerprint())
 
-        return True
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
 
     def __repr__(self):
         return f"TableData<{self.get_name()}, " \
                f"fields: {', '.join(str(field) for field in self.get_fields())}>"
 
 
+class TableIndex:
+    """
+    (unique) index over one or more columns of a table. The name is derived from
+    the definition and kept short enough for django's 30 character limit.
+    Built with CREATE INDEX CONCURRENTLY so writes to the table go on meanwhile.
+    """
+    __slots__ = ('table', 'fields', 'unique', 'name')
+
+    def __init__(self, table, fields, unique=False):
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'fields', tuple(fields))
+        object.__setattr__(self, 'unique', unique)
+        digest = UtilHelper.get_fingerprint([table, list(fields), unique])[:10]
+        object.__setattr__(self, 'name', f'{"ux" if unique else "ix"}_{table[:12]}_{digest}')
+
+    def to_dict(self):
+        return {'fields': list(self.fields), 'unique': self.unique}
+
+    def build_to_write(self) -> str:
+        fields = ', '.join(f"'{field}'" for field in self.fields)
+        if self.unique:
+            return f"models.UniqueConstraint(fields=[{fields}], name='{self.name}')"
+        return f"models.Index(fields=[{fields}], name='{self.name}')"
+
+    def build_create(self):
+        columns = ', '.join(UtilHelper.quote_identifier(field) for field in self.fields)
+        return f'CREATE {"UNIQUE " if self.unique else ""}INDEX CONCURRENTLY IF NOT EXISTS ' \
+               f'{UtilHelper.quote_identifier(self.name)} ON {UtilHelper.quote_identifier(self.table)} ({columns})'
+
+    def build_drop(self):
+        return f'DROP INDEX CONCURRENTLY IF EXISTS {UtilHelper.quote_identifier(self.name)}'
+
+    def __eq__(self, other):
+        if not isinstance(other, TableIndex):
+            return False
+
+        return self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __repr__(self):
+        return f'TableIndex({self.name}, {self.table}, {self.fields}, {self.unique})'
+
+
 class AbstractTableField:
+    """
+    immutable, instances are shared between requests through TableDataCache
+    """
+    __slots__ = ('name', 'length', 'nullable', 'default_value', 'index', 'unique', '_key')
+
+    _default_length = 255
+    _default_nullable = True
+    _default_value = ''
+
     def __init__(self, name, params):
-        self.name = name
-        self._params = params
-        self._default_length = 255
-        self._default_nullable = True
-        self._default_value = ''
-        self.length = self._get_length(params)
-        self.nullable = self._get_nullable(params)
-        self.default_value = self._get_default_value(params)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'length', self._get_length(params))
+        object.__setattr__(self, 'nullable', self._get_nullable(params))
+        object.__setattr__(self, 'default_value', self._get_default_value(params))
+        object.__setattr__(self, 'unique', self._get_flag(params, 'unique'))
+        object.__setattr__(self, 'index', self._get_flag(params, 'index') and not self.unique)
+        object.__setattr__(self, '_key', (self.get_type(), name, tuple(sorted(self.get_params().items()))))
 
     def _get_length(self, params):
         length = params.get('length', None)
@@ -341,6 +807,29 @@ class AbstractTableField:
             return default_value
         return self._default_value
 
+    # noinspection PyMethodMayBeStatic
+    def _get_flag(self, params, name):
+        return params.get(name, False) is True
+
+    def get_index_params(self) -> dict:
+        """
+        index params are left out while unset, so tables saved before they
+        existed keep their fingerprint
+        """
+        params = {}
+        if self.index:
+            params['index'] = True
+        if self.unique:
+            params['unique'] = True
+        return params
+
+    def build_index_kwargs(self) -> str:
+        if self.unique:
+            return ', unique=True'
+        if self.index:
+            return ', db_index=True'
+        return ''
+
     def to_dict(self):
         return {
             'name': self.name,
@@ -367,21 +856,76 @@ class AbstractTableField:
     def build_to_write(self) -> str:
         raise Exception('implement in child class')
 
+    @abstractmethod
+    def get_column_type(self) -> str:
+        raise Exception('implement in child class')
+
+    # noinspection PyMethodMayBeStatic
+    def get_column_default(self):
+        return None
+
+    # noinspection PyMethodMayBeStatic
+    def is_primary_key(self) -> bool:
+        return False
+
+    # noinspection PyMethodMayBeStatic
+    def is_sortable(self) -> bool:
+        """
+        rows can be paged by this field, it needs a total order without nulls
+        """
+        return False
+
+    def clean_value(self, value):
+        """
+        converts a value received from a client (json or csv text) to the value
+        stored in the column, raises ValueError when the column can't hold it
+        """
+        if value is None:
+            if self.nullable and not self.is_primary_key():
+                return None
+            raise ValueError(f'{self.name} can not be null')
+        return self._clean_value(value)
+
+    @abstractmethod
+    def _clean_value(self, value):
+        raise Exception('implement in child class')
+
+    def build_column_definition(self):
+        """
+        returns sql and params of the column as used in CREATE TABLE / ADD COLUMN
+        """
+        content_list = [UtilHelper.quote_identifier(self.name), self.get_column_type()]
+        params = []
+        if self.is_primary_key():
+            content_list.append('PRIMARY KEY')
+        elif not self.nullable:
+            content_list.append('NOT NULL')
+        default = self.get_column_default()
+        if default is not None:
+            content_list.append('DEFAULT %s')
+            params.append(default)
+        return ' '.join(content_list), params
+
     def __eq__(self, other):
         if not isinstance(other, AbstractTableField):
             return False
 
-        self_dict = self.to_dict()
-        other_dict = other.to_dict()
+        return self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
 
-        return json.dumps(self_dict, sort_keys=True) == json.dumps(other_dict, sort_keys=True)
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
 
     def __repr__(self):
         return f'{self.get_type()}({self.name}, ' \
-               f'({self.length}, {self.nullable}, {self._default_value}))'
+               f'({self.length}, {self.nullable}, {self.default_value}))'
 
 
 class PrimaryKeyField(AbstractTableField):
+    __slots__ = ()
+
     def __init__(self, name, params):
         super(PrimaryKeyField, self).__init__(name, params)
 
@@ -391,11 +935,40 @@ class PrimaryKeyField(AbstractTableField):
     def get_params(self) -> dict:
         return {}
 
+    def _get_flag(self, params, name):
+        # the primary key is indexed and unique already
+        return False
+
     def build_to_write(self) -> str:
         return f'{self.name} = models.IntegerField(primary_key=True)'
 
+    def get_column_type(self) -> str:
+        return 'integer'
+
+    def is_primary_key(self) -> bool:
+        return True
+
+    def is_sortable(self) -> bool:
+        return True
+
+    def clean_value(self, value):
+        return super(PrimaryKeyField, self).clean_value(None if value == '' else value)
+
+    def _clean_value(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError(f'{self.name} must be an integer')
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f'{self.name} must be an integer')
+        if not INTEGER_MIN <= value <= INTEGER_MAX:
+            raise ValueError(f'{self.name} is out of range')
+        return value
+
 
 class CharField(AbstractTableField):
+    __slots__ = ()
+
     def __init__(self, name, params):
         super(CharField, self).__init__(name, params)
 
@@ -407,36 +980,92 @@ class CharField(AbstractTableField):
             'length': self.length,
             'nullable': self.nullable,
             'default_value': self.default_value,
+            **self.get_index_params(),
         }
 
     def build_to_write(self) -> str:
         return f'{self.name} = models.CharField(max_length={self.length}, null={self.nullable}, ' \
-               f'blank={self.nullable}, default="{self.default_value}")'
+               f'blank={self.nullable}, default="{self.default_value}"{self.build_index_kwargs()})'
+
+    def get_column_type(self) -> str:
+        return f'varchar({self.length})'
+
+    def get_column_default(self):
+        return self.default_value
+
+    def is_sortable(self) -> bool:
+        return not self.nullable
+
+    def _clean_value(self, value):
+        if not isinstance(value, str):
+            raise ValueError(f'{self.name} must be a string')
+        if len(value) > self.length:
+            raise ValueError(f'{self.name} is longer than {self.length} characters')
+        return value
 
 
 class BooleanField(AbstractTableField):
+    __slots__ = ()
+
     def __init__(self, name, params):
         super(BooleanField, self).__init__(name, params)
 
     def get_type(self):
-        return TABLE_FIELD_CHAR_FIELD
+        return TABLE_FIELD_BOOLEAN_FIELD
 
     def get_params(self) -> dict:
         return {
             'length': self.length,
             'nullable': self.nullable,
             'default_value': self.nullable,
+            **self.get_index_params(),
         }
 
     def build_to_write(self) -> str:
         return f'{self.name} = models.BooleanField(null={self.nullable}, blank={self.nullable}, ' \
-               f'default="{self.default_value}")'
+               f'default="{self.default_value}"{self.build_index_kwargs()})'
+
+    def get_column_type(self) -> str:
+        return 'boolean'
+
+    def clean_value(self, value):
+        return super(BooleanField, self).clean_value(None if value == '' else value)
+
+    def _clean_value(self, value):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.lower() in BOOLEAN_VALUES:
+            return BOOLEAN_VALUES[value.lower()]
+        if isinstance(value, int) and value in (0, 1):
+            return value == 1
+        raise ValueError(f'{self.name} must be a boolean')
 
 
 TABLE_FIELD_PRIMARY_KEY_FIELD = 'PrimaryKeyField'
 TABLE_FIELD_CHAR_FIELD = 'CharField'
 TABLE_FIELD_BOOLEAN_FIELD = 'BooleanField'
 
+# noinspection SqlDialectInspection
+EXISTING_TABLES_SQL = "SELECT relname FROM pg_class " \
+                      "WHERE relnamespace = current_schema()::regnamespace AND relkind IN ('r', 'p', 'v', 'm', 'f')"
+
+IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]{0,62}$')
+
+# attributes django models need for themselves
+RESERVED_FIELD_NAMES = ('pk', 'objects', 'Meta')
+
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+BOOLEAN_VALUES = {
+    'true': True,
+    't': True,
+    '1': True,
+    'false': False,
+    'f': False,
+    '0': False,
+}
+
 
 class TableFieldFactory:
     @staticmethod
@@ -458,12 +1087,12 @@ def dbname(name):
     return DbHelper.get_table_name(name)
 
 
-def fetchone(sql):
-    return DbHelper.fetchone(sql)
+def fetchone(sql, params=None):
+    return DbHelper.fetchone(sql, params)
 
 
-def fetchall(sql):
-    return DbHelper.fetchall(sql)
+def fetchall(sql, params=None):
+    return DbHelper.fetchall(sql, params)
 
 
 class SettingsHelper:
@@ -474,34 +1103,15 @@ class SettingsHelper:
         if cls._is_inited:
             return
         cls._is_inited = True
-        cls.load_dynamic_modules()
-        cls.load_dynamic_connections()
-        cls.restart_server()
-
-    @classmethod
-    def restart_server(cls):
-        apps.app_configs = OrderedDict()
-        apps.apps_ready = apps.models_ready = apps.loading = apps.ready = False
-        apps.clear_cache()
-        apps.populate(settings.INSTALLED_APPS)
-        # management.call_command('migrate', new_app_name, interactive=False)
+        if TENANT_APPS_EAGER_LOAD:
+            cls.load_dynamic_modules()
 
     @classmethod
     def load_dynamic_modules(cls):
-        settings.INSTALLED_APPS += (module for module in UserDatabaseHelper.get_app_modules())
-
-    @classmethod
-    def load_dynamic_connections(cls):
-        databases = settings.DATABASES
-        for dynamic_db in UserDatabaseHelper.get_app_databases():
-            databases.update({
-                dynamic_db: {
-                    'ENGINE': 'django.db.backends.postgresql',
-                    'NAME': dynamic_db,
-                    'USER': MAIN_DATABASE_USER,
-                    'PASSWORD': MAIN_DATABASE_PASSWORD,
-                    'HOST': MAIN_DATABASE_HOST,
-                    'PORT': MAIN_DATABASE_PORT,
-                }
-            })
-        settings.DATABASES = databases
+        """
+        tenant apps are loaded on first request, management commands
+        working on tenant apps can load all of them upfront
+        """
+        for app in UserDatabaseHelper.get_app_databases():
+            TenantAppRegistry.load(app)
+            TenantConnectionRegistry.ensure(app)
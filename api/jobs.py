@@ -0,0 +1,271 @@
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from api.middleware import get_user_database, get_user_token, set_tenant_context, reset_tenant_context
+from api.models import SchemaJob
+from app.settings import SCHEMA_JOB_WORKERS, SCHEMA_JOB_POLL_INTERVAL, SCHEMA_JOB_DEBOUNCE, SCHEMA_BATCH_MAX_TABLES
+
+logger = logging.getLogger(__name__)
+
+# hashed together with the tenant into the key of its advisory lock
+SCHEMA_LOCK_NAMESPACE = 'schema_job'
+
+
+class TenantSchemaLock:
+    """
+    postgres advisory lock on the main database, held while the schema of a
+    tenant changes. Serializes schema changes of a tenant across all worker
+    processes, the server releases it if the holder dies. Never waited for,
+    whoever holds it takes over the queued jobs of the tenant.
+    """
+
+    @staticmethod
+    def acquire(database):
+        """
+        returns False when another session holds the lock
+        """
+        key = TenantSchemaLock.get_key(database)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s::bigint)', [key])
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def release(database):
+        key = TenantSchemaLock.get_key(database)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s::bigint)', [key])
+
+    @staticmethod
+    def get_key(database):
+        # 64 bits, tenants sharing a key would leave each other's jobs queued
+        digest = hashlib.sha256(f'{SCHEMA_LOCK_NAMESPACE}:{database}'.encode()).digest()
+        return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+class SchemaJobQueue:
+    """
+    Runs schema changes of the current tenant on a background worker pool.
+
+    Jobs are stored in the schema_job table so their status can be read
+    from any worker process, waiting on a job started by this process
+    does not need to poll.
+
+    Jobs a tenant submits within SCHEMA_JOB_DEBOUNCE seconds are merged into
+    one change (later definitions of a table win), so a burst writes models.py
+    and runs migrations once. The worker holding the TenantSchemaLock also
+    takes over jobs of the tenant queued by other processes, a worker that
+    can't take the lock leaves its jobs to the holder instead of waiting.
+
+    Jobs left queued or running by a process that died are taken over by the
+    next worker holding the lock of the tenant. Each process looks for them
+    when it starts running jobs, waiting on a job of another process also
+    looks for them.
+    """
+    _executor = None
+    _lock = threading.Lock()
+    _events = {}
+    _pending = {}
+
+    @classmethod
+    def submit(cls, tables):
+        """
+        tables: [{'name': 'users', 'fields': {...}}, ...]
+        """
+        database = get_user_database()
+        job = SchemaJob.objects.create(database=database, payload={'tables': tables})
+        event = threading.Event()
+        with cls._lock:
+            cls._events[job.pk] = event
+            pending = cls._pending.get(database)
+            if pending is not None:
+                pending.append(job.pk)
+                return job
+            cls._pending[database] = [job.pk]
+        timer = threading.Timer(SCHEMA_JOB_DEBOUNCE, cls._schedule, (database, get_user_token()))
+        timer.daemon = True
+        timer.start()
+        return job
+
+    @classmethod
+    def get(cls, job_id, database):
+        return SchemaJob.objects.filter(pk=job_id, database=database).first()
+
+    @classmethod
+    def wait(cls, job_id, database, timeout):
+        deadline = time.monotonic() + timeout
+        event = cls._events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        job = cls.get(job_id, database)
+        if event is None and job is not None and not job.is_finished():
+            # submitted by another process, which may have died since
+            cls._schedule(database, None)
+        while job is not None and not job.is_finished():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(SCHEMA_JOB_POLL_INTERVAL, remaining))
+            job = cls.get(job_id, database)
+        return job
+
+    @classmethod
+    def _schedule(cls, database, token):
+        cls._get_executor().submit(cls._run, database, token)
+
+    @classmethod
+    def _run(cls, database, token):
+        with cls._lock:
+            job_ids = cls._pending.pop(database, [])
+        close_old_connections()
+        context_token = set_tenant_context(database, token)
+        try:
+            # a job queued while the lock is being released finds it still
+            # held, check again once it is free
+            while TenantSchemaLock.acquire(database):
+                try:
+                    cls._requeue_running(database)
+                    while cls._run_queued(database):
+                        pass
+                except Exception as e:
+                    logger.exception('schema jobs of %s failed', database)
+                    SchemaJob.objects.filter(pk__in=job_ids).exclude(status__in=SchemaJob.FINISHED_STATUSES).update(
+                        status=SchemaJob.STATUS_FAILED,
+                        error=str(e),
+                        finished_at=timezone.now(),
+                    )
+                finally:
+                    TenantSchemaLock.release(database)
+                if not cls._has_queued(database):
+                    break
+        except Exception:
+            logger.exception('schema jobs of %s could not be started', database)
+        finally:
+            reset_tenant_context(context_token)
+            with cls._lock:
+                events = [cls._events.pop(job_id, None) for job_id in job_ids]
+            for event in events:
+                if event is not None:
+                    event.set()
+            close_old_connections()
+
+    @staticmethod
+    def _requeue_running(database):
+        """
+        only the lock holder runs jobs, running ones found by the next holder
+        were left by a worker that died
+        """
+        requeued = SchemaJob.objects.filter(database=database, status=SchemaJob.STATUS_RUNNING).update(
+            status=SchemaJob.STATUS_QUEUED,
+            started_at=None,
+        )
+        if requeued:
+            logger.warning('requeued %s schema jobs of %s left running', requeued, database)
+
+    @classmethod
+    def _recover(cls):
+        close_old_connections()
+        try:
+            unfinished = SchemaJob.objects.exclude(status__in=SchemaJob.FINISHED_STATUSES)
+            for database in set(unfinished.values_list('database', flat=True)):
+                cls._schedule(database, None)
+        except Exception:
+            logger.exception('looking for unfinished schema jobs failed')
+        finally:
+            close_old_connections()
+
+    @staticmethod
+    def _has_queued(database):
+        return SchemaJob.objects.filter(database=database, status=SchemaJob.STATUS_QUEUED).exists()
+
+    @classmethod
+    def _run_queued(cls, database):
+        """
+        applies the queued jobs of the tenant as one change, as many as fit in
+        SCHEMA_BATCH_MAX_TABLES tables. Returns False when none was queued.
+        Only called while holding the TenantSchemaLock of the tenant.
+        """
+        queued = SchemaJob.objects.filter(database=database, status=SchemaJob.STATUS_QUEUED).order_by('created_at')
+        jobs = []
+        tables = {}
+        for job in queued:
+            merged = {**tables, **{table['name']: table for table in job.payload['tables']}}
+            if jobs and len(merged) > SCHEMA_BATCH_MAX_TABLES:
+                break
+            jobs.append(job)
+            tables = merged
+        if not jobs:
+            return False
+        SchemaJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status=SchemaJob.STATUS_RUNNING,
+            started_at=timezone.now(),
+        )
+        from api.helpers import IndexBuildError
+        try:
+            cls._apply(list(tables.values()))
+            cls._finish(jobs)
+        except IndexBuildError as e:
+            # the tables were changed already, applying the jobs again would
+            # diff older definitions against the committed ones
+            logger.exception('indexes of schema jobs %s failed', ', '.join(str(job.pk) for job in jobs))
+            cls._finish(jobs, e)
+        except Exception as e:
+            logger.exception('schema jobs %s failed', ', '.join(str(job.pk) for job in jobs))
+            if len(jobs) == 1:
+                cls._finish(jobs, e)
+            else:
+                # nothing was changed, one bad change should not fail the rest of the burst
+                cls._run_one_by_one(jobs)
+        return True
+
+    @classmethod
+    def _run_one_by_one(cls, jobs):
+        """
+        applies the jobs of a failed batch one at a time. A table defined again
+        by a later job of the batch is left to that job, the earlier job ends
+        like the later one.
+        """
+        owners = {}
+        for i, job in enumerate(jobs):
+            for table in job.payload['tables']:
+                owners[table['name']] = i
+        errors = {}
+        for i, job in enumerate(jobs):
+            tables = [table for table in job.payload['tables'] if owners[table['name']] == i]
+            if not tables:
+                continue
+            try:
+                cls._apply(tables)
+            except Exception as e:
+                logger.exception('schema job %s failed', job.pk)
+                errors[i] = e
+        for i, job in enumerate(jobs):
+            owner_errors = [errors.get(owners[table['name']]) for table in job.payload['tables']]
+            cls._finish([job], next((error for error in owner_errors if error is not None), None))
+
+    @staticmethod
+    def _finish(jobs, error=None):
+        SchemaJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status=SchemaJob.STATUS_FAILED if error else SchemaJob.STATUS_SUCCEEDED,
+            error=str(error) if error else '',
+            finished_at=timezone.now(),
+        )
+
+    @staticmethod
+    def _apply(tables):
+        from api.helpers import UserDatabaseHelper
+        UserDatabaseHelper.create_tables(tables)
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._lock:
+            if cls._executor is not None:
+                return cls._executor
+            cls._executor = ThreadPoolExecutor(max_workers=SCHEMA_JOB_WORKERS, thread_name_prefix='schema-job')
+        cls._executor.submit(cls._recover)
+        return cls._executor
@@ -0,0 +1,40 @@
+import json
+
+from django.core.management import BaseCommand, CommandError
+
+from api.benchmark import Benchmark, BenchmarkError
+
+
+class Command(BaseCommand):
+    help = 'Provisions tenants and measures latency, throughput, connections and memory of the API hot paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tenants', type=int, default=10)
+        parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--batch-size', type=int, default=100, help='rows per bulk insert request')
+        parser.add_argument('--scenarios', default=','.join(Benchmark.SCENARIOS),
+                            help='comma separated, from: ' + ', '.join(Benchmark.SCENARIOS))
+        parser.add_argument('--base-url', default=None,
+                            help='send requests to a running server instead of through this process')
+        parser.add_argument('--output', default=None, help='json file for the results, stdout by default')
+
+    def handle(self, *args, **options):
+        benchmark = Benchmark(
+            tenants=options['tenants'],
+            requests=options['requests'],
+            concurrency=options['concurrency'],
+            batch_size=options['batch_size'],
+            base_url=options['base_url'],
+            scenarios=[name.strip() for name in options['scenarios'].split(',') if name.strip()],
+        )
+        try:
+            results = benchmark.run()
+        except BenchmarkError as e:
+            raise CommandError(str(e))
+        content = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(content + '\n')
+        else:
+            self.stdout.write(content)
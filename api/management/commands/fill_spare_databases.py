@@ -0,0 +1,15 @@
+from django.core.management import BaseCommand
+
+from api.provisioning import ProvisioningRegistry
+from app.settings import TENANT_SPARE_DATABASES
+
+
+class Command(BaseCommand):
+    help = 'Clones spare tenant databases from the template until enough of them are ready'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=TENANT_SPARE_DATABASES)
+
+    def handle(self, *args, **options):
+        created = ProvisioningRegistry.fill(options['count'])
+        self.stdout.write(f'created {created} spare databases')
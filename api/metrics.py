@@ -0,0 +1,187 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from api.profiling import RequestProfiler
+from app.settings import METRICS_ENABLED, METRICS_MAX_SERIES, METRICS_LATENCY_BUCKETS
+
+OTHER_LABEL = '_other'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class MetricFamily:
+    """
+    one metric with its series keyed by label values. Once METRICS_MAX_SERIES
+    series exist, new label values are folded into a single `_other` series
+    so tenants and tables can't grow the registry without bound.
+    """
+
+    def __init__(self, name, kind, description, label_names):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.label_names = label_names
+        self.series = {}
+
+    def get_series(self, labels):
+        series = self.series.get(labels)
+        if series is None:
+            if len(self.series) >= METRICS_MAX_SERIES:
+                labels = (OTHER_LABEL,) * len(self.label_names)
+                series = self.series.get(labels)
+            if series is None:
+                series = Histogram(METRICS_LATENCY_BUCKETS) if self.kind == 'histogram' else [0]
+                self.series[labels] = series
+        return series
+
+    def render(self):
+        content_list = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for labels, series in self.series.items():
+            pairs = list(zip(self.label_names, labels))
+            if self.kind != 'histogram':
+                content_list.append(f'{self.name}{_format_labels(pairs)} {series[0]}')
+                continue
+            cumulative = 0
+            for bound, count in zip(series.buckets, series.counts):
+                cumulative += count
+                content_list.append(f'{self.name}_bucket{_format_labels(pairs + [("le", bound)])} {cumulative}')
+            content_list.append(f'{self.name}_bucket{_format_labels(pairs + [("le", "+Inf")])} {series.count}')
+            content_list.append(f'{self.name}_sum{_format_labels(pairs)} {series.sum}')
+            content_list.append(f'{self.name}_count{_format_labels(pairs)} {series.count}')
+        return '\n'.join(content_list)
+
+
+class QueryRecord:
+    __slots__ = ('rows',)
+
+    def __init__(self):
+        self.rows = 0
+
+
+class Metrics:
+    """
+    In-process aggregation of request, query and connection pool numbers per
+    tenant and table, rendered in the Prometheus text format at GET /metrics.
+    Every worker process keeps its own numbers, scrape each of them.
+    """
+    _lock = threading.Lock()
+
+    REQUEST_SECONDS = MetricFamily(
+        'api_request_duration_seconds', 'histogram', 'Time spent on API requests',
+        ('tenant', 'method', 'status'),
+    )
+    QUERY_SECONDS = MetricFamily(
+        'api_query_duration_seconds', 'histogram', 'Time spent on tenant database queries',
+        ('tenant', 'table'),
+    )
+    QUERY_ROWS = MetricFamily(
+        'api_query_rows_total', 'counter', 'Rows returned or written by tenant database queries',
+        ('tenant', 'table'),
+    )
+    QUERY_ERRORS = MetricFamily(
+        'api_query_errors_total', 'counter', 'Tenant database queries that raised',
+        ('tenant', 'table'),
+    )
+    CHECKOUTS = MetricFamily(
+        'api_pool_checkouts_total', 'counter', 'Connections checked out of the tenant connection pools',
+        ('tenant',),
+    )
+    CHECKOUT_SECONDS = MetricFamily(
+        'api_pool_checkout_duration_seconds', 'histogram', 'Time spent waiting for a pooled connection',
+        ('tenant',),
+    )
+    FAMILIES = (REQUEST_SECONDS, QUERY_SECONDS, QUERY_ROWS, QUERY_ERRORS, CHECKOUTS, CHECKOUT_SECONDS)
+
+    @classmethod
+    def inc(cls, family, labels, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with cls._lock:
+            family.get_series(labels)[0] += amount
+
+    @classmethod
+    def observe(cls, family, labels, value):
+        if not METRICS_ENABLED:
+            return
+        with cls._lock:
+            family.get_series(labels).observe(value)
+
+    @classmethod
+    def record_request(cls, tenant, method, status, seconds):
+        cls.observe(cls.REQUEST_SECONDS, (tenant or '', method, str(status)), seconds)
+
+    @classmethod
+    def record_checkout(cls, tenant, seconds):
+        cls.inc(cls.CHECKOUTS, (tenant,))
+        cls.observe(cls.CHECKOUT_SECONDS, (tenant,), seconds)
+
+    @classmethod
+    @contextmanager
+    def time_query(cls, tenant, table=None):
+        """
+        times the block as one query, set `rows` on the yielded record
+        """
+        labels = (tenant or '', table or '')
+        record = QueryRecord()
+        RequestProfiler.add_query()
+        started_at = time.perf_counter()
+        try:
+            yield record
+        except Exception:
+            cls.inc(cls.QUERY_ERRORS, labels)
+            raise
+        finally:
+            cls.observe(cls.QUERY_SECONDS, labels, time.perf_counter() - started_at)
+            if record.rows > 0:
+                cls.inc(cls.QUERY_ROWS, labels, record.rows)
+
+    @classmethod
+    def render(cls, pool_stats=None):
+        """
+        pool_stats: {database: {'size': .., 'idle': ..}} as returned by the pool,
+        rendered as gauges next to the aggregated metrics
+        """
+        with cls._lock:
+            content_list = [family.render() for family in cls.FAMILIES]
+        if pool_stats is not None:
+            content_list.append('# HELP api_pool_connections Open connections of the tenant connection pool')
+            content_list.append('# TYPE api_pool_connections gauge')
+            for database, stats in pool_stats.items():
+                for state, count in (('idle', stats['idle']), ('in_use', stats['size'] - stats['idle'])):
+                    labels = _format_labels([('database', database), ('state', state)])
+                    content_list.append(f'api_pool_connections{labels} {count}')
+        return '\n'.join(content_list) + '\n'
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            for family in cls.FAMILIES:
+                family.series.clear()
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    values = ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs)
+    return '{' + values + '}'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,53 +1,199 @@
-import threading
+import asyncio
+import contextvars
+import time
+
+from asgiref.sync import sync_to_async
 from django.http import HttpResponseForbidden
 
-THREAD_LOCAL = threading.local()
+from api.metrics import Metrics
+from api.profiling import RequestProfiler
+from app.settings import API_MIDDLEWARE_EXEMPT_PATHS
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+TENANT_CONTEXT = contextvars.ContextVar('tenant_context', default=None)
+
+
+class TenantContext:
+    def __init__(self, database, user_token=None, request=None):
+        self.database = database
+        self.user_token = user_token
+        self.request = request
 
 
 class APIMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self._is_async = asyncio.iscoroutinefunction(get_response)
+        if self._is_async:
+            markcoroutinefunction(self)
 
     # noinspection PyMethodMayBeStatic
     def validate_request(self, request):
         user_token = request.headers.get('Authorization', None)
         if user_token is None:
             return False
-        from api.models import UserTokenDatabase
-        if UserTokenDatabase.objects.filter(token=user_token).count() < 1:
-            return False
-        return True
+        return get_token_database(user_token) is not None
 
     def __call__(self, request):
-        if not self.validate_request(request):
+        if self._is_async:
+            return self.__acall__(request)
+        if request.path in API_MIDDLEWARE_EXEMPT_PATHS:
+            return self.get_response(request)
+        # a worker thread keeps the context of its previous request otherwise
+        context_token = TENANT_CONTEXT.set(None)
+        started_at = time.perf_counter()
+        try:
+            if RequestProfiler.is_enabled():
+                response = self.handle_profiled(request)
+            else:
+                response = self.handle(request)
+            Metrics.record_request(get_user_database(), request.method, response.status_code,
+                                   time.perf_counter() - started_at)
+        finally:
+            reset_tenant_context(context_token)
+        return response
+
+    def handle_profiled(self, request):
+        profile, profile_token = RequestProfiler.start()
+        profiler = RequestProfiler.start_sampling()
+        try:
+            response = self.handle(request)
+        finally:
+            if profiler is not None:
+                RequestProfiler.finish_sampling(profiler, request, profile)
+            RequestProfiler.finish(profile_token)
+        response['Server-Timing'] = profile.build_server_timing()
+        return response
+
+    def handle(self, request):
+        with RequestProfiler.phase('auth'):
+            is_valid = self.validate_request(request)
+        if not is_valid:
             return HttpResponseForbidden(content='Please, provide user_token')
-        init_thread(request)
+        with RequestProfiler.phase('tenant'):
+            init_tenant_context(request)
         from api.helpers import UserDatabaseHelper
-        UserDatabaseHelper.prepare_environment()
-        response = self.get_response(request)
+        from api.registry import TenantAppRegistry, TenantConnectionRegistry
+        with RequestProfiler.phase('provision'):
+            UserDatabaseHelper.prepare_environment()
+        with RequestProfiler.phase('app'):
+            TenantAppRegistry.load(get_user_database())
+        try:
+            with RequestProfiler.phase('view'):
+                response = self.get_response(request)
+        finally:
+            with RequestProfiler.phase('sweep'):
+                TenantConnectionRegistry.sweep()
+        return response
+
+    async def __acall__(self, request):
+        if request.path in API_MIDDLEWARE_EXEMPT_PATHS:
+            return await self.get_response(request)
+        started_at = time.perf_counter()
+        if RequestProfiler.is_enabled():
+            response = await self.ahandle_profiled(request)
+        else:
+            response = await self.ahandle(request)
+        Metrics.record_request(get_user_database(), request.method, response.status_code,
+                               time.perf_counter() - started_at)
         return response
 
+    async def ahandle_profiled(self, request):
+        """
+        no cProfile sampling here, it would account other requests running on the event loop
+        """
+        profile, profile_token = RequestProfiler.start()
+        try:
+            response = await self.ahandle(request)
+        finally:
+            RequestProfiler.finish(profile_token)
+        response['Server-Timing'] = profile.build_server_timing()
+        return response
 
-def init_thread(request):
+    async def ahandle(self, request):
+        """
+        same steps as handle, each one stays on the event loop while it is
+        answered from memory and only goes to a thread when it needs the database
+        """
+        user_token = request.headers.get('Authorization', None)
+        with RequestProfiler.phase('auth'):
+            is_valid = user_token is not None and await aget_token_database(user_token) is not None
+        if not is_valid:
+            return HttpResponseForbidden(content='Please, provide user_token')
+        with RequestProfiler.phase('tenant'):
+            await ainit_tenant_context(request)
+        from api.provisioning import ProvisioningRegistry
+        from api.registry import TenantAppRegistry, TenantConnectionRegistry
+        database = get_user_database()
+        with RequestProfiler.phase('provision'):
+            if not ProvisioningRegistry.is_known(database):
+                await sync_to_async(ProvisioningRegistry.ensure)(database)
+        with RequestProfiler.phase('app'):
+            if not TenantAppRegistry.is_loaded(database):
+                await sync_to_async(TenantAppRegistry.load)(database)
+        try:
+            with RequestProfiler.phase('view'):
+                response = await self.get_response(request)
+        finally:
+            with RequestProfiler.phase('sweep'):
+                if TenantConnectionRegistry.is_sweep_due():
+                    await sync_to_async(TenantConnectionRegistry.sweep)()
+        return response
+
+
+def init_tenant_context(request):
+    token = request.headers['Authorization']
+    set_tenant_context(get_token_database(token), token, request)
+
+
+async def ainit_tenant_context(request):
     token = request.headers['Authorization']
-    from api.models import UserTokenDatabase
-    model = UserTokenDatabase.objects.filter(token=token).get()
-    _klass = get_current_thread_class()
-    _klass.request = request
-    _klass.user_token = token
-    _klass.database = model.database
+    set_tenant_context(await aget_token_database(token), token, request)
+
+
+def set_tenant_context(database, token=None, request=None):
+    """
+    sets the tenant of the current request, task or background job,
+    returns a token for reset_tenant_context
+    """
+    return TENANT_CONTEXT.set(TenantContext(database, token, request))
+
+
+def reset_tenant_context(context_token):
+    TENANT_CONTEXT.reset(context_token)
+
+
+def get_token_database(token):
+    from api.cache import TokenDatabaseCache
+    return TokenDatabaseCache.get_database(token)
+
+
+async def aget_token_database(token):
+    from api.cache import TokenDatabaseCache
+    database = TokenDatabaseCache.get_cached_database(token)
+    if database is None:
+        database = await sync_to_async(TokenDatabaseCache.get_database)(token)
+    return database
 
 
 def get_user_token():
-    _klass = get_current_thread_class()
-    return _klass.user_token
+    context = get_tenant_context()
+    return context.user_token if context else None
 
 
 def get_user_database():
-    _klass = get_current_thread_class()
-    return _klass.database
-
+    context = get_tenant_context()
+    return context.database if context else None
 
-def get_current_thread_class():
-    return THREAD_LOCAL
 
+def get_tenant_context():
+    return TENANT_CONTEXT.get()
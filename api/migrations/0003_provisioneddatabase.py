@@ -0,0 +1,24 @@
+# Generated by Django 4.0.4 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_usertable'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisionedDatabase',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(max_length=255, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'provisioned_database',
+            },
+        ),
+    ]
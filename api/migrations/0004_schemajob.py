@@ -0,0 +1,30 @@
+# Generated by Django 4.0.4 on 2026-10-18 08:40
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_provisioneddatabase'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchemaJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('database', models.CharField(max_length=255)),
+                ('status', models.CharField(default='queued', max_length=20)),
+                ('payload', models.JSONField()),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'db_table': 'schema_job',
+            },
+        ),
+    ]
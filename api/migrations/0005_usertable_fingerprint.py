@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_schemajob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertable',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_usertable_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provisioneddatabase',
+            name='status',
+            field=models.CharField(db_index=True, default='assigned', max_length=20),
+        ),
+    ]
@@ -0,0 +1,79 @@
+import importlib
+import io
+import sys
+
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+
+from api.registry import TenantAppRegistry, TenantConnectionRegistry
+
+
+class MigrationError(Exception):
+    pass
+
+
+class MigrationResult:
+    def __init__(self, app, database, applied, output):
+        self.app = app
+        self.database = database
+        self.applied = applied
+        self.output = output
+
+    def __repr__(self):
+        return f'MigrationResult<{self.app}, database: {self.database}, applied: {", ".join(self.applied)}>'
+
+
+class MigrationEngine:
+    """
+    Runs makemigrations and migrate for a tenant app inside the current process.
+
+    Runs of an app hold its lock in the tenant app registry, so the app is
+    not uninstalled meanwhile. The registry wide lock is held only while the
+    models are reloaded and makemigrations reads the installed apps, the
+    migrations themselves run next to requests and migrations of other apps.
+    """
+
+    @classmethod
+    def run(cls, app, database):
+        with TenantAppRegistry.get_app_lock(app):
+            output = io.StringIO()
+            try:
+                if not TenantAppRegistry.load(app):
+                    raise MigrationError(f'app {app} does not exist')
+                TenantConnectionRegistry.ensure(database)
+                with TenantAppRegistry.lock:
+                    cls.reload_models(app)
+                    call_command('makemigrations', app, interactive=False, verbosity=1, stdout=output)
+                applied = cls.migrate(app, database)
+            except Exception as e:
+                raise MigrationError(f"migrations for {app} failed: {e}") from e
+        return MigrationResult(app, database, applied, output.getvalue())
+
+    @staticmethod
+    def migrate(app, database):
+        # the executor is used directly, migrate command would also run
+        # post_migrate handlers of every installed app against the tenant database
+        importlib.invalidate_caches()
+        connection = connections[database]
+        executor = MigrationExecutor(connection)
+        executor.loader.check_consistent_history(connection)
+        targets = [key for key in executor.loader.graph.leaf_nodes() if key[0] == app]
+        plan = executor.migration_plan(targets)
+        if plan:
+            executor.migrate(targets, plan=plan)
+        return [migration.name for migration, backwards in plan]
+
+    @staticmethod
+    def reload_models(app):
+        """
+        models.py of the app is rewritten on every schema change,
+        drop the previously imported classes and import it again
+        """
+        app_config = apps.get_app_config(app)
+        importlib.invalidate_caches()
+        apps.all_models[app].clear()
+        sys.modules.pop(f'{app_config.name}.models', None)
+        app_config.import_models()
+        apps.clear_cache()
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 
 # Create your models here.
@@ -14,12 +16,31 @@ class UserTokenDatabase(models.Model):
 
     @staticmethod
     def create_token_and_database():
+        """
+        takes a spare database when one is ready and creates one otherwise
+        """
         token = UtilHelper.get_random_string(255)
-        database = 'frontend_database_' + UtilHelper.get_random_string(25).lower()
+        from api.provisioning import ProvisioningRegistry
+        database = ProvisioningRegistry.claim()
+        if database is None:
+            database = ProvisioningRegistry.get_new_database_name()
+            ProvisioningRegistry.provision(database)
         UserTokenDatabase(token=token, database=database).save()
         return token, database
 
 
+class ProvisionedDatabase(models.Model):
+    STATUS_SPARE = 'spare'
+    STATUS_ASSIGNED = 'assigned'
+
+    database = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=20, default=STATUS_ASSIGNED, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'provisioned_database'
+
+
 class DatabaseManager(models.Manager):
     def get_queryset(self):
         database = get_user_database()
@@ -30,6 +51,8 @@ class UserTable(models.Model):
     database = models.CharField(max_length=255)
     name = models.CharField(max_length=120)
     data = models.JSONField()
+    # TableData.get_fingerprint() of data, empty for rows saved before it existed
+    fingerprint = models.CharField(max_length=64, blank=True, default='')
 
     objects = DatabaseManager()
 
@@ -42,3 +65,36 @@ class UserTable(models.Model):
         if not self.database:
             self.database = get_user_database()
         super(UserTable, self).save(force_insert, force_update, using, update_fields)
+
+
+class SchemaJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    database = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, default=STATUS_QUEUED)
+    payload = models.JSONField()
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'schema_job'
+
+    def is_finished(self):
+        return self.status in self.FINISHED_STATUSES
+
+    def to_dict(self):
+        return {
+            'id': str(self.id),
+            'status': self.status,
+            'error': self.error or None,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
@@ -0,0 +1,452 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+import psycopg2
+from django.core.exceptions import ImproperlyConfigured
+from psycopg2 import extensions, sql
+
+try:
+    import psycopg
+    from psycopg import sql as psycopg_sql
+except ImportError:
+    psycopg = psycopg_sql = None
+
+from app.settings import MAIN_DATABASE_USER, MAIN_DATABASE_PASSWORD, MAIN_DATABASE_HOST, MAIN_DATABASE_PORT, \
+    USER_DATABASE_POOL_MAX_SIZE, USER_DATABASE_POOL_MAX_TOTAL, USER_DATABASE_POOL_IDLE_TIMEOUT, \
+    USER_DATABASE_POOL_CHECKOUT_TIMEOUT, USER_DATABASE_POOL_HEALTH_CHECK_INTERVAL
+from api.metrics import Metrics
+from api.tenancy import TenantStorage
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, database, connection):
+        self.database = database
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        # None until a schema is selected, the server default applies then
+        self.search_path = None
+
+    def is_closed(self):
+        return bool(self.connection.closed)
+
+    def is_idle_for(self, seconds, now=None):
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_used_at >= seconds
+
+    def close(self):
+        # noinspection PyBroadException
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+    async def aclose(self):
+        # noinspection PyBroadException
+        try:
+            await self.connection.close()
+        except Exception:
+            pass
+
+
+class BaseTenantConnectionPool:
+    """
+    Bookkeeping shared by the sync and async pools, keyed by tenant database name.
+    Callers hold the pool lock and close the connections handed back to them.
+
+    max_size: connections kept open per tenant database
+    max_total: connections kept open across all tenant databases
+    idle_timeout: seconds an unused connection stays in the pool
+    checkout_timeout: seconds to wait for a free slot before giving up
+    health_check_interval: connections idle longer than this are pinged on checkout
+    """
+
+    def __init__(self, max_size, max_total, idle_timeout, checkout_timeout, health_check_interval):
+        self.max_size = max_size
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._idle = {}
+        self._sizes = {}
+        self._total = 0
+        # connections opened over the lifetime of the pool
+        self.opened = 0
+
+    def stats(self):
+        return {
+            database: {
+                'size': size,
+                'idle': len(self._idle.get(database, [])),
+            }
+            for database, size in self._sizes.items()
+        }
+
+    def _take(self, database):
+        """
+        returns (idle connection or None, whether a slot for a new connection
+        was reserved, connections to close)
+        """
+        to_close = self._expire_idle()
+        idle = self._idle.get(database)
+        if idle:
+            return idle.pop(), False, to_close
+        if self._sizes.get(database, 0) < self.max_size:
+            if self._total >= self.max_total:
+                evicted = self._evict_one_idle()
+                if evicted is not None:
+                    to_close.append(evicted)
+            if self._total < self.max_total:
+                self._sizes[database] = self._sizes.get(database, 0) + 1
+                self._total += 1
+                self.opened += 1
+                return None, True, to_close
+        return None, False, to_close
+
+    def _put_idle(self, pooled):
+        pooled.last_used_at = time.monotonic()
+        self._idle.setdefault(pooled.database, []).append(pooled)
+
+    def _take_all_idle(self, database):
+        idle = self._idle.pop(database, [])
+        for pooled in idle:
+            self._release(pooled.database)
+        return idle
+
+    def _release(self, database):
+        size = self._sizes.get(database, 0) - 1
+        if size > 0:
+            self._sizes[database] = size
+        else:
+            self._sizes.pop(database, None)
+            self._idle.pop(database, None)
+        self._total -= 1
+
+    def _expire_idle(self):
+        now = time.monotonic()
+        expired = []
+        for database in list(self._idle):
+            idle = self._idle[database]
+            expired_here = [pooled for pooled in idle if pooled.is_idle_for(self.idle_timeout, now)]
+            if not expired_here:
+                continue
+            idle[:] = [pooled for pooled in idle if pooled not in expired_here]
+            for pooled in expired_here:
+                self._release(database)
+            expired.extend(expired_here)
+        return expired
+
+    def _evict_one_idle(self):
+        oldest = None
+        for idle in self._idle.values():
+            if idle and (oldest is None or idle[0].last_used_at < oldest.last_used_at):
+                oldest = idle[0]
+        if oldest is None:
+            return None
+        self._idle[oldest.database].remove(oldest)
+        self._release(oldest.database)
+        return oldest
+
+
+class TenantConnectionPool(BaseTenantConnectionPool):
+    """
+    Bounded pool of psycopg2 connections to tenant databases, safe to share between threads
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TenantConnectionPool, self).__init__(*args, **kwargs)
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def connection(self, database, search_path=None):
+        pooled = self.checkout(database, search_path)
+        try:
+            yield pooled.connection
+        finally:
+            self.checkin(pooled)
+
+    def checkout(self, database, search_path=None):
+        """
+        search_path: schema the connection should resolve tables in,
+        connections are shared between the tenants of a database
+        """
+        started_at = time.monotonic()
+        pooled = self._checkout(database)
+        try:
+            self._set_search_path(pooled, search_path)
+        except Exception:
+            self._discard(pooled)
+            raise
+        Metrics.record_checkout(search_path or database, time.monotonic() - started_at)
+        return pooled
+
+    def _checkout(self, database):
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            pooled = self._acquire(database, deadline)
+            if pooled is None:
+                return self._open(database)
+            if self._is_healthy(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def checkin(self, pooled):
+        if pooled.is_closed() or not self._reset(pooled):
+            self._discard(pooled)
+            return
+        with self._condition:
+            self._put_idle(pooled)
+            self._condition.notify()
+
+    def close_database(self, database):
+        with self._condition:
+            idle = self._take_all_idle(database)
+            self._condition.notify_all()
+        for pooled in idle:
+            pooled.close()
+
+    def close_all(self):
+        with self._condition:
+            databases = list(self._idle)
+        for database in databases:
+            self.close_database(database)
+
+    def stats(self):
+        with self._condition:
+            return super(TenantConnectionPool, self).stats()
+
+    def _acquire(self, database, deadline):
+        """
+        returns an idle connection for the database, or None when a slot
+        for a new connection has been reserved
+        """
+        with self._condition:
+            while True:
+                pooled, reserved, to_close = self._take(database)
+                for closing in to_close:
+                    closing.close()
+                if pooled is not None or reserved:
+                    return pooled
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedError(f'no connection available for {database}')
+                self._condition.wait(remaining)
+
+    def _open(self, database):
+        try:
+            connection = psycopg2.connect(
+                database=database,
+                user=MAIN_DATABASE_USER,
+                password=MAIN_DATABASE_PASSWORD,
+                host=MAIN_DATABASE_HOST,
+                port=MAIN_DATABASE_PORT,
+            )
+            connection.autocommit = True
+        except Exception:
+            with self._condition:
+                self._release(database)
+                self._condition.notify()
+            raise
+        return PooledConnection(database, connection)
+
+    def _is_healthy(self, pooled):
+        if pooled.is_closed():
+            return False
+        if not pooled.is_idle_for(self.health_check_interval):
+            return True
+        # noinspection PyBroadException
+        try:
+            with pooled.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    # noinspection PyMethodMayBeStatic
+    def _set_search_path(self, pooled, search_path):
+        if pooled.search_path == search_path:
+            return
+        with pooled.connection.cursor() as cursor:
+            if search_path is None:
+                cursor.execute('RESET search_path')
+            else:
+                cursor.execute(sql.SQL('SET search_path TO {}').format(sql.Identifier(search_path)))
+        pooled.search_path = search_path
+
+    # noinspection PyMethodMayBeStatic
+    def _reset(self, pooled):
+        connection = pooled.connection
+        if connection.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE and connection.autocommit:
+            return True
+        # noinspection PyBroadException
+        try:
+            connection.rollback()
+            connection.autocommit = True
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, pooled):
+        pooled.close()
+        with self._condition:
+            self._release(pooled.database)
+            self._condition.notify()
+
+
+class AsyncTenantConnectionPool(BaseTenantConnectionPool):
+    """
+    asyncio pool of psycopg 3 connections to tenant databases, for the async
+    request path under ASGI. Bound to the event loop it is first used on.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncTenantConnectionPool, self).__init__(*args, **kwargs)
+        self._condition = asyncio.Condition()
+
+    @staticmethod
+    def check_available():
+        if psycopg is None:
+            raise ImproperlyConfigured('API_ASYNC_VIEWS needs psycopg 3, pip install "psycopg[binary]"')
+
+    @asynccontextmanager
+    async def connection(self, database, search_path=None):
+        pooled = await self.checkout(database, search_path)
+        try:
+            yield pooled.connection
+        finally:
+            await self.checkin(pooled)
+
+    async def checkout(self, database, search_path=None):
+        started_at = time.monotonic()
+        pooled = await self._checkout(database)
+        try:
+            await self._set_search_path(pooled, search_path)
+        except Exception:
+            await self._discard(pooled)
+            raise
+        Metrics.record_checkout(search_path or database, time.monotonic() - started_at)
+        return pooled
+
+    async def _checkout(self, database):
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            pooled = await self._acquire(database, deadline)
+            if pooled is None:
+                return await self._open(database)
+            if await self._is_healthy(pooled):
+                return pooled
+            await self._discard(pooled)
+
+    async def checkin(self, pooled):
+        if pooled.is_closed() or not await self._reset(pooled):
+            await self._discard(pooled)
+            return
+        async with self._condition:
+            self._put_idle(pooled)
+            self._condition.notify()
+
+    async def close_all(self):
+        async with self._condition:
+            idle = []
+            for database in list(self._idle):
+                idle.extend(self._take_all_idle(database))
+            self._condition.notify_all()
+        for pooled in idle:
+            await pooled.aclose()
+
+    async def _acquire(self, database, deadline):
+        async with self._condition:
+            while True:
+                pooled, reserved, to_close = self._take(database)
+                for closing in to_close:
+                    await closing.aclose()
+                if pooled is not None or reserved:
+                    return pooled
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedError(f'no connection available for {database}')
+                try:
+                    await asyncio.wait_for(self._condition.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _open(self, database):
+        try:
+            self.check_available()
+            connection = await psycopg.AsyncConnection.connect(
+                dbname=database,
+                user=MAIN_DATABASE_USER,
+                password=MAIN_DATABASE_PASSWORD,
+                host=MAIN_DATABASE_HOST,
+                port=MAIN_DATABASE_PORT,
+                autocommit=True,
+            )
+        except Exception:
+            async with self._condition:
+                self._release(database)
+                self._condition.notify()
+            raise
+        return PooledConnection(database, connection)
+
+    async def _is_healthy(self, pooled):
+        if pooled.is_closed():
+            return False
+        if not pooled.is_idle_for(self.health_check_interval):
+            return True
+        # noinspection PyBroadException
+        try:
+            await pooled.connection.execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    # noinspection PyMethodMayBeStatic
+    async def _set_search_path(self, pooled, search_path):
+        if pooled.search_path == search_path:
+            return
+        if search_path is None:
+            await pooled.connection.execute('RESET search_path')
+        else:
+            await pooled.connection.execute(
+                psycopg_sql.SQL('SET search_path TO {}').format(psycopg_sql.Identifier(search_path))
+            )
+        pooled.search_path = search_path
+
+    # noinspection PyMethodMayBeStatic
+    async def _reset(self, pooled):
+        connection = pooled.connection
+        if connection.info.transaction_status == psycopg.pq.TransactionStatus.IDLE and connection.autocommit:
+            return True
+        # noinspection PyBroadException
+        try:
+            await connection.rollback()
+            await connection.set_autocommit(True)
+            return True
+        except Exception:
+            return False
+
+    async def _discard(self, pooled):
+        await pooled.aclose()
+        async with self._condition:
+            self._release(pooled.database)
+            self._condition.notify()
+
+
+POOL_SETTINGS = {
+    # in schema mode every tenant shares the connections to one database
+    'max_size': USER_DATABASE_POOL_MAX_TOTAL if TenantStorage.is_schema_mode() else USER_DATABASE_POOL_MAX_SIZE,
+    'max_total': USER_DATABASE_POOL_MAX_TOTAL,
+    'idle_timeout': USER_DATABASE_POOL_IDLE_TIMEOUT,
+    'checkout_timeout': USER_DATABASE_POOL_CHECKOUT_TIMEOUT,
+    'health_check_interval': USER_DATABASE_POOL_HEALTH_CHECK_INTERVAL,
+}
+
+connection_pool = TenantConnectionPool(**POOL_SETTINGS)
+async_connection_pool = AsyncTenantConnectionPool(**POOL_SETTINGS)
@@ -0,0 +1,127 @@
+import contextvars
+import cProfile
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+
+from app.settings import REQUEST_PROFILING_ENABLED, REQUEST_PROFILE_SAMPLE_RATE, REQUEST_PROFILE_SLOW_THRESHOLD, \
+    REQUEST_PROFILE_DIR
+
+REQUEST_PROFILE = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    """
+    durations and query counts of the phases of one request
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.queries = 0
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        queries = self.queries
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started_at, self.queries - queries))
+
+    def get_duration(self):
+        return time.perf_counter() - self.started_at
+
+    def build_server_timing(self):
+        """
+        Server-Timing header value, durations in milliseconds
+        """
+        content_list = [
+            f'{name};dur={seconds * 1000:.2f};desc="{queries} queries"'
+            for name, seconds, queries in self.phases
+        ]
+        content_list.append(f'total;dur={self.get_duration() * 1000:.2f};desc="{self.queries} queries"')
+        return ', '.join(content_list)
+
+
+class RequestProfiler:
+    """
+    Opt-in request profiling enabled with REQUEST_PROFILING_ENABLED.
+
+    APIMiddleware reports its phases in a Server-Timing header together with
+    the SQL queries run in each, counted on django connections (see
+    api/signals.py) and on the tenant connection pool (see api/metrics.py).
+    REQUEST_PROFILE_SAMPLE_RATE of the synchronous requests also run under
+    cProfile, stats of those slower than REQUEST_PROFILE_SLOW_THRESHOLD
+    seconds are dumped to REQUEST_PROFILE_DIR.
+    """
+
+    @staticmethod
+    def is_enabled():
+        return REQUEST_PROFILING_ENABLED
+
+    @staticmethod
+    def start():
+        """
+        returns the new profile and a token for finish()
+        """
+        profile = RequestProfile()
+        return profile, REQUEST_PROFILE.set(profile)
+
+    @staticmethod
+    def finish(context_token):
+        REQUEST_PROFILE.reset(context_token)
+
+    @staticmethod
+    @contextmanager
+    def phase(name):
+        profile = REQUEST_PROFILE.get()
+        if profile is None:
+            yield
+            return
+        with profile.phase(name):
+            yield
+
+    @staticmethod
+    def add_query():
+        profile = REQUEST_PROFILE.get()
+        if profile is not None:
+            profile.queries += 1
+
+    @staticmethod
+    def count_query(execute, sql, params, many, context):
+        """
+        execute wrapper for django connections
+        """
+        RequestProfiler.add_query()
+        return execute(sql, params, many, context)
+
+    @staticmethod
+    def start_sampling():
+        """
+        returns a running cProfile.Profile for a sampled request, None otherwise
+        """
+        if REQUEST_PROFILE_SAMPLE_RATE <= 0 or random.random() >= REQUEST_PROFILE_SAMPLE_RATE:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active in this thread
+            return None
+        return profiler
+
+    @staticmethod
+    def finish_sampling(profiler, request, profile):
+        profiler.disable()
+        duration = profile.get_duration()
+        if duration < REQUEST_PROFILE_SLOW_THRESHOLD:
+            return None
+        os.makedirs(REQUEST_PROFILE_DIR, exist_ok=True)
+        path = re.sub(r'[^A-Za-z0-9_-]+', '_', request.path).strip('_')
+        name = f'{int(time.time() * 1000)}_{request.method}_{path}_{int(duration * 1000)}ms.prof'
+        stats_file = os.path.join(REQUEST_PROFILE_DIR, name)
+        profiler.dump_stats(stats_file)
+        return stats_file
@@ -0,0 +1,190 @@
+import logging
+import threading
+
+import psycopg2
+from django.db import connection, close_old_connections
+from psycopg2 import errors, sql
+
+from api.pool import connection_pool
+from api.tenancy import TenantStorage
+from api.utils import UtilHelper
+from app.settings import MAIN_DATABASE, MAIN_DATABASE_USER, MAIN_DATABASE_PASSWORD, MAIN_DATABASE_HOST, \
+    MAIN_DATABASE_PORT, TENANT_SHARED_DATABASE, TENANT_TEMPLATE_DATABASE, TENANT_SPARE_DATABASES, \
+    TENANT_SPARE_FILL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# noinspection SqlDialectInspection
+CLAIM_SPARE_DATABASE_SQL = "UPDATE provisioned_database SET status = %s " \
+                           "WHERE id = (SELECT id FROM provisioned_database WHERE status = %s " \
+                           "ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED) " \
+                           "RETURNING database"
+
+
+class ProvisioningRegistry:
+    """
+    Keeps track of tenant databases (or schemas, see api/tenancy.py) that already exist.
+
+    Known databases are remembered in memory and in the provisioned_database
+    table, so a request for an existing tenant never issues CREATE DATABASE.
+
+    New tenant databases are cloned from TENANT_TEMPLATE_DATABASE. Spare ones
+    are cloned ahead of time by SpareDatabaseFiller, a signup claims one of
+    them with a single UPDATE.
+    """
+    _provisioned = set()
+    _shared_database_created = False
+    _template_created = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_known(cls, database):
+        return database in cls._provisioned
+
+    @classmethod
+    def is_provisioned(cls, database):
+        if database in cls._provisioned:
+            return True
+        from api.models import ProvisionedDatabase
+        if ProvisionedDatabase.objects.filter(database=database).exists():
+            cls._provisioned.add(database)
+            return True
+        return False
+
+    @classmethod
+    def ensure(cls, database):
+        if not cls.is_provisioned(database):
+            cls.provision(database)
+
+    @classmethod
+    def provision(cls, database):
+        from api.models import ProvisionedDatabase
+        with cls._lock:
+            if database in cls._provisioned:
+                return
+            if TenantStorage.is_schema_mode():
+                cls.create_schema(database)
+            else:
+                cls.create_database(database, cls.ensure_template())
+            ProvisionedDatabase.objects.get_or_create(database=database)
+            cls._provisioned.add(database)
+
+    @classmethod
+    def claim(cls):
+        """
+        assigns a spare database to a new tenant, None when no spare is ready
+        """
+        if TenantStorage.is_schema_mode():
+            return None
+        from api.models import ProvisionedDatabase
+        with connection.cursor() as cursor:
+            cursor.execute(CLAIM_SPARE_DATABASE_SQL,
+                           [ProvisionedDatabase.STATUS_ASSIGNED, ProvisionedDatabase.STATUS_SPARE])
+            row = cursor.fetchone()
+        SpareDatabaseFiller.wake()
+        if row is None:
+            return None
+        cls._provisioned.add(row[0])
+        return row[0]
+
+    @classmethod
+    def fill(cls, count=TENANT_SPARE_DATABASES):
+        """
+        clones spare databases until `count` of them are ready, returns how many were created.
+        Processes filling at the same time may overshoot by a few databases.
+        """
+        if TenantStorage.is_schema_mode():
+            return 0
+        from api.models import ProvisionedDatabase
+        missing = count - ProvisionedDatabase.objects.filter(status=ProvisionedDatabase.STATUS_SPARE).count()
+        for _ in range(missing):
+            database = cls.get_new_database_name()
+            cls.create_database(database, cls.ensure_template())
+            ProvisionedDatabase.objects.create(database=database, status=ProvisionedDatabase.STATUS_SPARE)
+        return max(missing, 0)
+
+    @classmethod
+    def forget(cls, database):
+        cls._provisioned.discard(database)
+
+    @staticmethod
+    def get_new_database_name():
+        return 'frontend_database_' + UtilHelper.get_random_string(25).lower()
+
+    @classmethod
+    def ensure_template(cls):
+        """
+        creates the template database on first use. Clones copy whatever it holds
+        (extensions, shared tables), nothing may stay connected to it.
+        """
+        if not cls._template_created:
+            cls.create_database(TENANT_TEMPLATE_DATABASE)
+            cls._template_created = True
+        return TENANT_TEMPLATE_DATABASE
+
+    @classmethod
+    def create_schema(cls, schema):
+        if not cls._shared_database_created:
+            cls.create_database(TENANT_SHARED_DATABASE)
+            cls._shared_database_created = True
+        with connection_pool.connection(TENANT_SHARED_DATABASE) as conn:
+            with conn.cursor() as cursor:
+                # noinspection SqlDialectInspection
+                cursor.execute(sql.SQL('CREATE SCHEMA IF NOT EXISTS {}').format(sql.Identifier(schema)))
+
+    @classmethod
+    def create_database(cls, database, template=None):
+        conn = cls._connect(MAIN_DATABASE)
+        try:
+            with conn.cursor() as cursor:
+                # noinspection SqlDialectInspection
+                query = sql.SQL('CREATE DATABASE {}').format(sql.Identifier(database))
+                if template is not None:
+                    query = sql.SQL('{} TEMPLATE {}').format(query, sql.Identifier(template))
+                cursor.execute(query)
+        except errors.DuplicateDatabase:
+            pass
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _connect(database):
+        conn = psycopg2.connect(
+            database=database,
+            user=MAIN_DATABASE_USER,
+            password=MAIN_DATABASE_PASSWORD,
+            host=MAIN_DATABASE_HOST,
+            port=MAIN_DATABASE_PORT,
+        )
+        conn.autocommit = True
+        return conn
+
+
+class SpareDatabaseFiller:
+    """
+    daemon thread keeping TENANT_SPARE_DATABASES spare databases ready. Started
+    by the first claim, woken by later ones and every TENANT_SPARE_FILL_INTERVAL seconds.
+    """
+    _thread = None
+    _wake = threading.Event()
+    _lock = threading.Lock()
+
+    @classmethod
+    def wake(cls):
+        with cls._lock:
+            if cls._thread is None:
+                cls._thread = threading.Thread(target=cls._run, name='spare-database-filler', daemon=True)
+                cls._thread.start()
+        cls._wake.set()
+
+    @classmethod
+    def _run(cls):
+        while True:
+            cls._wake.clear()
+            try:
+                ProvisioningRegistry.fill()
+            except Exception:
+                logger.exception('filling spare databases failed')
+            finally:
+                close_old_connections()
+            cls._wake.wait(TENANT_SPARE_FILL_INTERVAL)
@@ -0,0 +1,145 @@
+import base64
+import binascii
+import json
+
+from api.utils import UtilHelper
+
+
+class RowQueryError(Exception):
+    """
+    param: the query parameter that was wrong
+    """
+
+    def __init__(self, message, param=None):
+        super(RowQueryError, self).__init__(message)
+        self.param = param
+
+
+class RowQuery:
+    """
+    Builds parameterized SELECT statements for a tenant table from its TableData,
+    only columns declared in the table can be selected
+    """
+
+    def __init__(self, table_data, columns=None):
+        self.table_data = table_data
+        self.fields = self._get_selected_fields(columns)
+
+    def get_columns(self):
+        return [field.name for field in self.fields]
+
+    def build_select(self):
+        table = UtilHelper.quote_identifier(self.table_data.get_name())
+        columns = ', '.join(UtilHelper.quote_identifier(field.name) for field in self.fields)
+        return f'SELECT {columns} FROM {table}', []
+
+    def page(self, limit, order_by=None, descending=False, cursor=None):
+        """
+        keyset pagination, rows are ordered by (order_by, primary key).
+        A cursor continues after the last row of the previous page and
+        carries the order it was created with.
+        """
+        primary_key = self._get_primary_key()
+        after = None
+        if cursor:
+            order_by, descending, after = self.decode_cursor(cursor)
+        try:
+            sort_fields = self._get_sort_fields(order_by or primary_key.name, primary_key)
+        except RowQueryError as e:
+            if cursor:
+                raise RowQueryError('invalid cursor', 'cursor') from e
+            raise e
+        if after is not None and len(after) != len(sort_fields):
+            raise RowQueryError('invalid cursor', 'cursor')
+        return RowPage(self, sort_fields, descending, after, limit)
+
+    @staticmethod
+    def encode_cursor(order_by, descending, values):
+        data = json.dumps({'o': order_by, 'd': descending, 'v': values}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            return data['o'], bool(data['d']), list(data['v'])
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            raise RowQueryError('invalid cursor', 'cursor')
+
+    def _get_primary_key(self):
+        for field in self.table_data.get_fields():
+            if field.is_primary_key():
+                return field
+        raise RowQueryError(f'{self.table_data.get_name()} has no primary key to page by', 'order_by')
+
+    def _get_sort_fields(self, order_by, primary_key):
+        if order_by == primary_key.name:
+            return [primary_key]
+        for field in self.table_data.get_fields():
+            if field.name == order_by:
+                if not field.is_sortable():
+                    raise RowQueryError(f'rows can not be ordered by {order_by}', 'order_by')
+                return [field, primary_key]
+        raise RowQueryError(f'unknown column: {order_by}', 'order_by')
+
+    def _get_selected_fields(self, columns):
+        fields = self.table_data.get_fields()
+        if not columns:
+            return list(fields)
+        fields_by_name = {field.name: field for field in fields}
+        unknown = [column for column in columns if column not in fields_by_name]
+        if unknown:
+            raise RowQueryError(f'unknown columns: {", ".join(unknown)}', 'columns')
+        return [fields_by_name[column] for column in dict.fromkeys(columns)]
+
+
+class RowPage:
+    """
+    one page of a RowQuery, sort columns missing from the projection are
+    selected as well to build the next cursor and left out of the result
+    """
+
+    def __init__(self, query, sort_fields, descending, after, limit):
+        self.query = query
+        self.sort_fields = sort_fields
+        self.descending = descending
+        self.after = after
+        self.limit = limit
+        self.selected = query.fields + [field for field in sort_fields if field not in query.fields]
+
+    def build_select(self):
+        """
+        selects one row more than limit to tell whether a next page exists
+        """
+        table = UtilHelper.quote_identifier(self.query.table_data.get_name())
+        columns = ', '.join(UtilHelper.quote_identifier(field.name) for field in self.selected)
+        sort_columns = ', '.join(UtilHelper.quote_identifier(field.name) for field in self.sort_fields)
+        direction = 'DESC' if self.descending else 'ASC'
+        content_list = [f'SELECT {columns} FROM {table}']
+        params = []
+        if self.after is not None:
+            placeholders = ', '.join(['%s'] * len(self.after))
+            content_list.append(f'WHERE ({sort_columns}) {"<" if self.descending else ">"} ({placeholders})')
+            params.extend(self.after)
+        content_list.append('ORDER BY ' + ', '.join(
+            f'{UtilHelper.quote_identifier(field.name)} {direction}' for field in self.sort_fields
+        ))
+        content_list.append('LIMIT %s')
+        params.append(self.limit + 1)
+        return ' '.join(content_list), params
+
+    def build_result(self, rows):
+        columns = self.query.get_columns()
+        selected = [field.name for field in self.selected]
+        next_cursor = None
+        if len(rows) > self.limit:
+            last = dict(zip(selected, rows[self.limit - 1]))
+            next_cursor = self.query.encode_cursor(
+                self.sort_fields[0].name,
+                self.descending,
+                [last[field.name] for field in self.sort_fields],
+            )
+        return {
+            'rows': [dict(zip(columns, row)) for row in rows[:self.limit]],
+            'next_cursor': next_cursor,
+        }
@@ -0,0 +1,228 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps, AppConfig
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from app import settings
+from app.settings import TENANT_APPS_MAX_LOADED, TENANT_CONNECTION_IDLE_TIMEOUT, TENANT_CONNECTION_SWEEP_INTERVAL, \
+    MAIN_DATABASE_USER, MAIN_DATABASE_PASSWORD, MAIN_DATABASE_HOST, MAIN_DATABASE_PORT
+from api.tenancy import TenantStorage
+
+
+class TenantAppRegistry:
+    """
+    Tenant apps under __apps__ are installed on first use instead of at startup.
+
+    At most TENANT_APPS_MAX_LOADED apps stay installed, the least recently used
+    one is uninstalled when another has to be loaded.
+
+    Loaded apps are answered without waiting on any other app. `lock` is held
+    only while django's app registry changes, the lock of an app
+    (get_app_lock) while it is installed, uninstalled or migrated. Hold the
+    lock of an app while reading its models or migrations so it is not
+    uninstalled meanwhile, an app whose lock is held is not evicted.
+    """
+    lock = threading.RLock()
+    _loaded = OrderedDict()
+    _loaded_lock = threading.Lock()
+    _app_locks = {}
+
+    @classmethod
+    def load(cls, app):
+        if cls._touch(app):
+            return True
+        with cls.get_app_lock(app):
+            if cls._touch(app):
+                return True
+            if not os.path.isdir(cls._get_app_path(app)):
+                # tenant without tables, nothing to install yet
+                return False
+            with cls.lock:
+                cls._install(app)
+                with cls._loaded_lock:
+                    cls._loaded[app] = True
+                cls._evict(app)
+            return True
+
+    @classmethod
+    def unload(cls, app):
+        with cls.get_app_lock(app), cls.lock:
+            with cls._loaded_lock:
+                loaded = cls._loaded.pop(app, None)
+            if loaded:
+                cls._uninstall(app)
+
+    @classmethod
+    def get_app_lock(cls, app):
+        with cls._loaded_lock:
+            app_lock = cls._app_locks.get(app)
+            if app_lock is None:
+                app_lock = cls._app_locks[app] = threading.RLock()
+            return app_lock
+
+    @classmethod
+    def _touch(cls, app):
+        with cls._loaded_lock:
+            if app not in cls._loaded:
+                return False
+            cls._loaded.move_to_end(app)
+            return True
+
+    @classmethod
+    def _evict(cls, loaded_app):
+        """
+        uninstalls least recently used apps over the limit, skipping the ones
+        in use. Called holding `lock`, apps locks are only tried so two loads
+        never wait on each other.
+        """
+        with cls._loaded_lock:
+            candidates = [app for app in cls._loaded if app != loaded_app]
+        excess = len(candidates) + 1 - TENANT_APPS_MAX_LOADED
+        for app in candidates:
+            if excess <= 0:
+                break
+            app_lock = cls.get_app_lock(app)
+            if not app_lock.acquire(blocking=False):
+                continue
+            try:
+                with cls._loaded_lock:
+                    loaded = cls._loaded.pop(app, None)
+                if loaded:
+                    cls._uninstall(app)
+                    excess -= 1
+            finally:
+                app_lock.release()
+
+    @classmethod
+    def is_loaded(cls, app):
+        with cls._loaded_lock:
+            return app in cls._loaded
+
+    @classmethod
+    def is_tenant_app(cls, app_label):
+        try:
+            app_config = apps.get_app_config(app_label)
+        except LookupError:
+            return False
+        from api.helpers import UserDatabaseHelper
+        return app_config.name.startswith(UserDatabaseHelper.get_app_path() + '.')
+
+    @classmethod
+    def _install(cls, app):
+        module = cls._get_module(app)
+        if apps.is_installed(module):
+            return
+        app_config = AppConfig.create(module)
+        app_config.apps = apps
+        apps.app_configs[app_config.label] = app_config
+        app_config.import_models()
+        apps.clear_cache()
+        settings.INSTALLED_APPS.append(module)
+
+    @classmethod
+    def _uninstall(cls, app):
+        module = cls._get_module(app)
+        app_config = apps.app_configs.pop(app, None)
+        if app_config is None:
+            return
+        apps.all_models.pop(app, None)
+        apps.clear_cache()
+        for name in [name for name in sys.modules if name == module or name.startswith(module + '.')]:
+            del sys.modules[name]
+        if module in settings.INSTALLED_APPS:
+            settings.INSTALLED_APPS.remove(module)
+
+    @staticmethod
+    def _get_app_path(app):
+        from api.helpers import UserDatabaseHelper
+        return UserDatabaseHelper.get_user_app_path(app)
+
+    @staticmethod
+    def _get_module(app):
+        from api.helpers import UserDatabaseHelper
+        return '.'.join([UserDatabaseHelper.get_app_path(), app])
+
+
+class TenantConnectionRegistry:
+    """
+    ORM connection aliases of tenant databases.
+
+    An alias is added to connections.settings the first time a tenant
+    database is used and removed again after TENANT_CONNECTION_IDLE_TIMEOUT
+    seconds without use. Django keeps a connection per alias and thread, each
+    thread closes its own connections to removed aliases when it sweeps.
+    """
+    _lock = threading.Lock()
+    _last_used = {}
+    _last_sweep = time.monotonic()
+    _thread = threading.local()
+
+    @classmethod
+    def ensure(cls, database):
+        with cls._lock:
+            if database not in connections.settings:
+                config = cls.get_database_config(database)
+                connections.configure_settings({
+                    DEFAULT_DB_ALIAS: connections.settings[DEFAULT_DB_ALIAS],
+                    database: config,
+                })
+                connections.settings[database] = config
+            cls._last_used[database] = time.monotonic()
+        cls._get_thread_aliases().add(database)
+        return database
+
+    @classmethod
+    def is_sweep_due(cls):
+        return time.monotonic() - cls._last_sweep >= TENANT_CONNECTION_SWEEP_INTERVAL
+
+    @classmethod
+    def sweep(cls, force=False):
+        now = time.monotonic()
+        if force or cls.is_sweep_due():
+            cls._last_sweep = now
+            with cls._lock:
+                for database, last_used in list(cls._last_used.items()):
+                    if now - last_used >= TENANT_CONNECTION_IDLE_TIMEOUT:
+                        del cls._last_used[database]
+                        connections.settings.pop(database, None)
+        cls._close_thread_connections()
+
+    @classmethod
+    def _close_thread_connections(cls):
+        aliases = cls._get_thread_aliases()
+        for database in [database for database in aliases if database not in cls._last_used]:
+            aliases.discard(database)
+            connection = getattr(connections._connections, database, None)
+            if connection is not None:
+                connection.close()
+                delattr(connections._connections, database)
+
+    @classmethod
+    def _get_thread_aliases(cls):
+        aliases = getattr(cls._thread, 'aliases', None)
+        if aliases is None:
+            aliases = cls._thread.aliases = set()
+        return aliases
+
+    @staticmethod
+    def get_database_config(database):
+        """
+        the alias is named after the tenant, in schema mode it connects to the
+        shared database with the search_path of the tenant
+        """
+        name, schema = TenantStorage.get_location(database)
+        config = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': name,
+            'USER': MAIN_DATABASE_USER,
+            'PASSWORD': MAIN_DATABASE_PASSWORD,
+            'HOST': MAIN_DATABASE_HOST,
+            'PORT': MAIN_DATABASE_PORT,
+        }
+        if schema is not None:
+            config['OPTIONS'] = {'options': f'-c search_path={schema}'}
+        return config
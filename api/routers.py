@@ -0,0 +1,27 @@
+from django.db import DEFAULT_DB_ALIAS
+
+from api.registry import TenantAppRegistry, TenantConnectionRegistry
+
+
+class TenantDatabaseRouter:
+    """
+    models of a tenant app live in the tenant database, the app label is the
+    database name, everything else stays in the default database
+    """
+
+    # noinspection PyUnusedLocal
+    def db_for_read(self, model, **hints):
+        app_label = model._meta.app_label
+        if TenantAppRegistry.is_tenant_app(app_label):
+            return TenantConnectionRegistry.ensure(app_label)
+        return None
+
+    db_for_write = db_for_read
+
+    # noinspection PyUnusedLocal
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if TenantAppRegistry.is_tenant_app(app_label):
+            return db == app_label
+        if db != DEFAULT_DB_ALIAS:
+            return False
+        return None
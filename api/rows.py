@@ -0,0 +1,245 @@
+import csv
+import io
+import json
+
+from api.utils import UtilHelper
+from app.settings import BULK_INSERT_CHUNK_SIZE, BULK_INSERT_MAX_ERRORS
+
+ROW_FORMAT_JSON = 'json'
+ROW_FORMAT_NDJSON = 'ndjson'
+ROW_FORMAT_CSV = 'csv'
+
+ROW_FORMATS_BY_CONTENT_TYPE = {
+    'application/json': ROW_FORMAT_JSON,
+    'application/x-ndjson': ROW_FORMAT_NDJSON,
+    'application/ndjson': ROW_FORMAT_NDJSON,
+    'application/jsonl': ROW_FORMAT_NDJSON,
+    'text/csv': ROW_FORMAT_CSV,
+}
+
+
+class RowFormatError(Exception):
+    pass
+
+
+class RowReader:
+    """
+    Reads rows sent by a client as (row dict, error) pairs, error is set
+    and row is None for rows that could not be parsed.
+
+    json: [{"id": 1, "name": "a"}, ...]
+    ndjson: one object per line
+    csv: header line with column names, then one row per line
+    """
+
+    @staticmethod
+    def get_format(content_type, requested_format=None):
+        if requested_format:
+            row_format = requested_format
+        else:
+            row_format = ROW_FORMATS_BY_CONTENT_TYPE.get((content_type or '').split(';')[0].strip())
+        if row_format not in (ROW_FORMAT_JSON, ROW_FORMAT_NDJSON, ROW_FORMAT_CSV):
+            raise RowFormatError('send rows as application/json, application/x-ndjson or text/csv')
+        return row_format
+
+    @staticmethod
+    def read(stream, row_format):
+        if row_format == ROW_FORMAT_JSON:
+            return RowReader._read_json(stream)
+        if row_format == ROW_FORMAT_NDJSON:
+            return RowReader._read_ndjson(stream)
+        return RowReader._read_csv(stream)
+
+    @staticmethod
+    def _iter_lines(stream):
+        if stream is None:
+            return
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            yield line.decode('utf-8') if isinstance(line, bytes) else line
+
+    @staticmethod
+    def _read_json(stream):
+        # a json array has to be parsed as a whole, prefer ndjson or csv for big imports
+        try:
+            rows = json.loads(stream.read()) if stream is not None else []
+        except ValueError as e:
+            raise RowFormatError(f'invalid json: {e}')
+        if not isinstance(rows, list):
+            raise RowFormatError('json body must be an array of objects')
+        for row in rows:
+            if isinstance(row, dict):
+                yield row, None
+            else:
+                yield None, 'row must be an object'
+
+    @staticmethod
+    def _read_ndjson(stream):
+        for line in RowReader._iter_lines(stream):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield None, f'invalid json: {e}'
+                continue
+            if isinstance(row, dict):
+                yield row, None
+            else:
+                yield None, 'row must be an object'
+
+    @staticmethod
+    def _read_csv(stream):
+        reader = csv.reader(RowReader._iter_lines(stream))
+        header = next(reader, None)
+        if header is None:
+            return
+        for values in reader:
+            if not values:
+                continue
+            if len(values) != len(header):
+                yield None, f'expected {len(header)} values, got {len(values)}'
+                continue
+            yield dict(zip(header, values)), None
+
+
+class BulkRowLoader:
+    """
+    Validates rows against the fields of a table and streams the valid ones
+    into it with COPY FROM STDIN, BULK_INSERT_CHUNK_SIZE rows per COPY.
+    """
+
+    def __init__(self, table_data, chunk_size=BULK_INSERT_CHUNK_SIZE, max_errors=BULK_INSERT_MAX_ERRORS):
+        self.table_data = table_data
+        self.fields = table_data.get_fields()
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def load(self, cursor, rows):
+        sql = self._build_copy_statement()
+        buffer = io.StringIO()
+        buffered = 0
+        for number, (row, error) in enumerate(rows, start=1):
+            values = None
+            if error is None:
+                try:
+                    values = self.clean_row(row)
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                self._reject(number, error)
+                continue
+            buffer.write(self._build_csv_line(values))
+            buffered += 1
+            if buffered >= self.chunk_size:
+                self._copy(cursor, sql, buffer)
+                self.accepted += buffered
+                buffer = io.StringIO()
+                buffered = 0
+        if buffered:
+            self._copy(cursor, sql, buffer)
+            self.accepted += buffered
+        return self.get_result()
+
+    def clean_row(self, row):
+        unknown = set(row) - {field.name for field in self.fields}
+        if unknown:
+            raise ValueError(f'unknown columns: {", ".join(sorted(unknown))}')
+        values = []
+        for field in self.fields:
+            value = row[field.name] if field.name in row else field.get_column_default()
+            values.append(field.clean_value(value))
+        return values
+
+    def get_result(self):
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
+
+    def _reject(self, number, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': number, 'error': error})
+
+    def _build_copy_statement(self):
+        table = UtilHelper.quote_identifier(self.table_data.get_name())
+        columns = ', '.join(UtilHelper.quote_identifier(field.name) for field in self.fields)
+        return f'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)'
+
+    @staticmethod
+    def _build_csv_line(values):
+        # unquoted empty value is NULL in COPY csv, every other value is quoted
+        content_list = []
+        for value in values:
+            if value is None:
+                content_list.append('')
+            else:
+                if isinstance(value, bool):
+                    value = 'true' if value else 'false'
+                content_list.append('"%s"' % str(value).replace('"', '""'))
+        return ','.join(content_list) + '\n'
+
+    @staticmethod
+    def _copy(cursor, sql, buffer):
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+
+
+class RowWriter:
+    """
+    Serializes rows read from a table as ndjson or csv text,
+    rows are grouped into chunks of batch_size rows
+    """
+
+    @staticmethod
+    def get_content_type(row_format):
+        if row_format == ROW_FORMAT_CSV:
+            return 'text/csv'
+        return 'application/x-ndjson'
+
+    @staticmethod
+    def write(columns, rows, row_format, batch_size):
+        if row_format == ROW_FORMAT_CSV:
+            return RowWriter._write_csv(columns, rows, batch_size)
+        return RowWriter._write_ndjson(columns, rows, batch_size)
+
+    @staticmethod
+    def _write_ndjson(columns, rows, batch_size):
+        content_list = []
+        for row in rows:
+            content_list.append(json.dumps(dict(zip(columns, row))) + '\n')
+            if len(content_list) >= batch_size:
+                yield ''.join(content_list)
+                content_list = []
+        if content_list:
+            yield ''.join(content_list)
+
+    @staticmethod
+    def _write_csv(columns, rows, batch_size):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        buffered = 0
+        for row in rows:
+            writer.writerow(['' if value is None else RowWriter._to_csv_value(value) for value in row])
+            buffered += 1
+            if buffered >= batch_size:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                buffered = 0
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    @staticmethod
+    def _to_csv_value(value):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return value
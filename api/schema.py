@@ -0,0 +1,137 @@
+from api.utils import UtilHelper
+
+SCHEMA_BACKEND_DDL = 'ddl'
+SCHEMA_BACKEND_MIGRATIONS = 'migrations'
+
+
+class SchemaDiff:
+    """
+    Compares two TableData instances and builds the statements turning the
+    table described by `old` into the one described by `new`.
+    `old` is None when the table does not exist yet.
+
+    statements are (sql, params) tuples, default values are passed as params.
+    Index changes are kept apart, CREATE INDEX CONCURRENTLY can't run inside
+    the transaction applying the statements.
+    """
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def has_changes(self):
+        return len(self.get_statements()) > 0 or any(self.get_index_changes())
+
+    def get_statements(self):
+        if self.old is None:
+            return [self._build_create_table()]
+        return self._build_alter_table()
+
+    def get_index_changes(self):
+        """
+        returns (indexes to drop, indexes to create)
+        """
+        old_indexes = self.old.get_indexes() if self.old is not None else []
+        new_indexes = self.new.get_indexes()
+        dropped = [index for index in old_indexes if index not in new_indexes]
+        created = [index for index in new_indexes if index not in old_indexes]
+        return dropped, created
+
+    def get_unique_checks(self):
+        """
+        (index, sql, params) for every unique index created on an existing table,
+        the query returns a row when the rows of the table repeat values of the
+        index. Columns added by this change hold their default in every row.
+        """
+        if self.old is None:
+            return []
+        old_fields = {field.name: field for field in self.old.get_fields()}
+        new_fields = {field.name: field for field in self.new.get_fields()}
+        checks = []
+        for index in self.get_index_changes()[1]:
+            if not index.unique:
+                continue
+            columns = []
+            params = []
+            for i, name in enumerate(index.fields):
+                new_field = new_fields[name]
+                column_type = new_field.get_column_type()
+                old_field = old_fields.get(name)
+                if old_field is None:
+                    columns.append(f'%s::{column_type} AS c{i}')
+                    params.append(new_field.get_column_default())
+                elif old_field.get_column_type() != column_type:
+                    columns.append(f'{UtilHelper.quote_identifier(name)}::{column_type} AS c{i}')
+                else:
+                    columns.append(f'{UtilHelper.quote_identifier(name)} AS c{i}')
+            aliases = [f'c{i}' for i in range(len(index.fields))]
+            table = UtilHelper.quote_identifier(self.new.get_name())
+            sql = f'SELECT 1 FROM (SELECT {", ".join(columns)} FROM {table}) AS checked ' \
+                  f'WHERE {" AND ".join(f"{alias} IS NOT NULL" for alias in aliases)} ' \
+                  f'GROUP BY {", ".join(aliases)} HAVING count(*) > 1 LIMIT 1'
+            checks.append((index, sql, params))
+        return checks
+
+    def _build_create_table(self):
+        columns = []
+        params = []
+        for field in self.new.get_fields():
+            column_sql, column_params = field.build_column_definition()
+            columns.append(column_sql)
+            params.extend(column_params)
+        table = UtilHelper.quote_identifier(self.new.get_name())
+        return f'CREATE TABLE {table} ({", ".join(columns)})', params
+
+    def _build_alter_table(self):
+        old_fields = {field.name: field for field in self.old.get_fields()}
+        new_fields = {field.name: field for field in self.new.get_fields()}
+        actions = []
+        params = []
+        for name in old_fields:
+            if name not in new_fields:
+                actions.append(f'DROP COLUMN {UtilHelper.quote_identifier(name)}')
+        for name, new_field in new_fields.items():
+            old_field = old_fields.get(name)
+            if old_field is None:
+                column_sql, column_params = new_field.build_column_definition()
+                actions.append(f'ADD COLUMN {column_sql}')
+                params.extend(column_params)
+            elif old_field != new_field:
+                column_actions, column_params = self._build_alter_column(old_field, new_field)
+                actions.extend(column_actions)
+                params.extend(column_params)
+        if not actions:
+            return []
+        table = UtilHelper.quote_identifier(self.new.get_name())
+        return [(f'ALTER TABLE {table} {", ".join(actions)}', params)]
+
+    def _build_alter_column(self, old_field, new_field):
+        column = UtilHelper.quote_identifier(new_field.name)
+        actions = []
+        params = []
+        if old_field.is_primary_key() and not new_field.is_primary_key():
+            constraint = UtilHelper.quote_identifier(f'{self.new.get_name()}_pkey')
+            actions.append(f'DROP CONSTRAINT {constraint}')
+        new_type = new_field.get_column_type()
+        old_type = old_field.get_column_type()
+        if old_type != new_type:
+            if new_type.startswith('varchar'):
+                # an explicit cast to varchar(n) truncates silently, assigning a
+                # longer value fails, so values are converted to text at most
+                using = '' if old_type.startswith('varchar') else f' USING {column}::text'
+            else:
+                using = f' USING {column}::{new_type}'
+            actions.append(f'ALTER COLUMN {column} TYPE {new_type}{using}')
+        if new_field.is_primary_key():
+            if not old_field.is_primary_key():
+                actions.append(f'ADD PRIMARY KEY ({column})')
+        elif old_field.is_primary_key() or old_field.nullable != new_field.nullable:
+            actions.append(f'ALTER COLUMN {column} {"DROP" if new_field.nullable else "SET"} NOT NULL')
+        new_default = new_field.get_column_default()
+        if old_field.get_column_default() != new_default:
+            if new_default is None:
+                actions.append(f'ALTER COLUMN {column} DROP DEFAULT')
+            else:
+                actions.append(f'ALTER COLUMN {column} SET DEFAULT %s')
+                params.append(new_default)
+        return actions, params
@@ -0,0 +1,23 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from api.cache import TokenDatabaseCache
+from api.models import UserTokenDatabase
+from api.profiling import RequestProfiler
+
+
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=UserTokenDatabase)
+@receiver(post_delete, sender=UserTokenDatabase)
+def invalidate_token_database(sender, instance, **kwargs):
+    # QuerySet.update() does not send signals, change tokens through save()
+    TokenDatabaseCache.invalidate(instance.token)
+    TokenDatabaseCache.invalidate_database(instance.database)
+
+
+# noinspection PyUnusedLocal
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    if RequestProfiler.is_enabled():
+        connection.execute_wrappers.append(RequestProfiler.count_query)
@@ -0,0 +1,33 @@
+from app.settings import TENANT_STORAGE_MODE, TENANT_SHARED_DATABASE
+
+TENANT_STORAGE_DATABASE = 'database'
+TENANT_STORAGE_SCHEMA = 'schema'
+
+
+class TenantStorage:
+    """
+    Where the tables of a tenant live, configured with TENANT_STORAGE_MODE.
+
+    database: every tenant has a database named after it
+    schema: every tenant has a schema named after it inside TENANT_SHARED_DATABASE,
+            connections select it through search_path
+    """
+
+    @staticmethod
+    def is_schema_mode():
+        return TENANT_STORAGE_MODE == TENANT_STORAGE_SCHEMA
+
+    @staticmethod
+    def get_database(tenant):
+        return TENANT_SHARED_DATABASE if TenantStorage.is_schema_mode() else tenant
+
+    @staticmethod
+    def get_schema(tenant):
+        return tenant if TenantStorage.is_schema_mode() else None
+
+    @staticmethod
+    def get_location(tenant):
+        """
+        returns (database, schema or None) holding the tables of the tenant
+        """
+        return TenantStorage.get_database(tenant), TenantStorage.get_schema(tenant)
@@ -1,3 +1,680 @@
-from django.test import TestCase
+import io
+import os
+import stat
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase
+from psycopg2 import extensions
+
+from api.cache import LRUCache, TokenDatabaseCache, TableDataCache, CatalogCache, TableVersions, QueryResultCache, \
+    CATALOG
+from api.helpers import TableData, UserDatabaseHelper, TableDataError, IndexBuildError
+from api.jobs import SchemaJobQueue, TenantSchemaLock
+from api.metrics import Metrics
+from api.models import SchemaJob
+from api.pool import TenantConnectionPool, PoolExhaustedError
+from api.queries import RowQuery, RowQueryError
+from api.rows import RowReader, BulkRowLoader, RowFormatError, ROW_FORMAT_JSON, ROW_FORMAT_NDJSON, ROW_FORMAT_CSV
+from api.schema import SchemaDiff
+from api.utils import UtilHelper
+
+
+def build_table(fields, indexes=None, name='users'):
+    data = {'name': name, 'fields': fields}
+    if indexes is not None:
+        data['indexes'] = indexes
+    return TableData(data)
+
+
+ID_FIELD = {'type': 'PrimaryKeyField', 'params': {}}
+
+
+def build_connection():
+    connection = mock.Mock(closed=0, autocommit=True)
+    connection.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+    return connection
+
+
+class TenantConnectionPoolTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('api.pool.psycopg2.connect', side_effect=lambda **kwargs: build_connection())
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def build_pool(max_size=2, max_total=3, idle_timeout=60):
+        return TenantConnectionPool(max_size, max_total, idle_timeout, 0, 60)
+
+    def test_idle_connections_are_reused(self):
+        pool = self.build_pool()
+        with pool.connection('tenant_a') as first:
+            pass
+        with pool.connection('tenant_a') as second:
+            self.assertIs(first, second)
+        self.assertEqual(pool.opened, 1)
+        self.assertEqual(pool.stats(), {'tenant_a': {'size': 1, 'idle': 1}})
+
+    def test_checkout_fails_when_database_is_full(self):
+        pool = self.build_pool()
+        pool.checkout('tenant_a')
+        pool.checkout('tenant_a')
+        with self.assertRaises(PoolExhaustedError):
+            pool.checkout('tenant_a')
+        self.assertEqual(pool.stats(), {'tenant_a': {'size': 2, 'idle': 0}})
+
+    def test_oldest_idle_connection_is_evicted_when_pool_is_full(self):
+        pool = self.build_pool()
+        oldest = pool.checkout('tenant_a')
+        newer = pool.checkout('tenant_b')
+        pool.checkout('tenant_c')
+        pool.checkin(oldest)
+        pool.checkin(newer)
+        pool.checkout('tenant_d')
+        oldest.connection.close.assert_called_once_with()
+        newer.connection.close.assert_not_called()
+        self.assertEqual(pool.stats(), {
+            'tenant_b': {'size': 1, 'idle': 1},
+            'tenant_c': {'size': 1, 'idle': 0},
+            'tenant_d': {'size': 1, 'idle': 0},
+        })
+
+    def test_checkout_fails_when_nothing_can_be_evicted(self):
+        pool = self.build_pool(max_total=1)
+        pool.checkout('tenant_a')
+        with self.assertRaises(PoolExhaustedError):
+            pool.checkout('tenant_b')
+
+    def test_failed_connect_releases_its_slot(self):
+        pool = self.build_pool(max_size=1)
+        self.connect.side_effect = OSError('refused')
+        with self.assertRaises(OSError):
+            pool.checkout('tenant_a')
+        self.assertEqual(pool.stats(), {})
+        self.connect.side_effect = lambda **kwargs: build_connection()
+        pool.checkout('tenant_a')
+
+    def test_broken_connections_are_not_returned_to_the_pool(self):
+        pool = self.build_pool()
+        pooled = pool.checkout('tenant_a')
+        pooled.connection.closed = 1
+        pool.checkin(pooled)
+        self.assertEqual(pool.stats(), {})
+
+    def test_idle_connections_expire(self):
+        pool = self.build_pool(idle_timeout=5)
+        with mock.patch('api.pool.time.monotonic', return_value=100):
+            pooled = pool.checkout('tenant_a')
+            pool.checkin(pooled)
+        with mock.patch('api.pool.time.monotonic', return_value=105):
+            pool.checkout('tenant_b')
+        pooled.connection.close.assert_called_once_with()
+        self.assertEqual(pool.stats(), {'tenant_b': {'size': 1, 'idle': 0}})
+
+
+class TokenDatabaseCacheTests(SimpleTestCase):
+    def setUp(self):
+        TokenDatabaseCache.clear()
+        caches['default'].clear()
+        patcher = mock.patch.object(TokenDatabaseCache, '_load', return_value='tenant_a')
+        self.load = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(TokenDatabaseCache.clear)
+
+    def test_lookups_are_cached_until_invalidated(self):
+        self.assertEqual(TokenDatabaseCache.get_database('token'), 'tenant_a')
+        self.assertEqual(TokenDatabaseCache.get_database('token'), 'tenant_a')
+        self.assertEqual(self.load.call_count, 1)
+        self.assertEqual(TokenDatabaseCache.get_cached_database('token'), 'tenant_a')
+        TokenDatabaseCache.invalidate('token')
+        self.assertIsNone(TokenDatabaseCache.get_cached_database('token'))
+        self.load.return_value = 'tenant_b'
+        self.assertEqual(TokenDatabaseCache.get_database('token'), 'tenant_b')
+
+    def test_tokens_of_a_database_are_invalidated(self):
+        TokenDatabaseCache.get_database('a')
+        self.load.return_value = 'tenant_b'
+        TokenDatabaseCache.get_database('b')
+        TokenDatabaseCache.invalidate_database('tenant_a')
+        self.assertIsNone(TokenDatabaseCache.get_cached_database('a'))
+        self.assertEqual(TokenDatabaseCache.get_cached_database('b'), 'tenant_b')
+
+    def test_unknown_tokens_are_not_cached(self):
+        self.load.return_value = None
+        self.assertIsNone(TokenDatabaseCache.get_database('token'))
+        self.assertIsNone(TokenDatabaseCache.get_cached_database('token'))
+
+    @mock.patch('api.cache.TOKEN_CACHE_BACKEND', 'default')
+    def test_shared_cache_is_the_only_cache_when_configured(self):
+        self.assertEqual(TokenDatabaseCache.get_database('token'), 'tenant_a')
+        self.assertIsNone(TokenDatabaseCache.get_cached_database('token'))
+        # another process dropped the token from the shared cache
+        caches['default'].clear()
+        self.load.return_value = 'tenant_b'
+        self.assertEqual(TokenDatabaseCache.get_database('token'), 'tenant_b')
+        TokenDatabaseCache.invalidate('token')
+        self.load.return_value = None
+        self.assertIsNone(TokenDatabaseCache.get_database('token'))
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        cache = LRUCache(10, ttl=5)
+        with mock.patch('api.cache.time.monotonic', return_value=100):
+            cache.set('a', 1)
+        with mock.patch('api.cache.time.monotonic', return_value=104):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('api.cache.time.monotonic', return_value=105):
+            self.assertIsNone(cache.get('a'))
+
+    def test_entries_are_evicted_by_weight(self):
+        cache = LRUCache(10, max_weight=10)
+        cache.set('a', 1, weight=6)
+        cache.set('b', 2, weight=6)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['weight'], 6)
+
+
+class SchemaDiffTests(SimpleTestCase):
+    def test_new_table_is_created(self):
+        table = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'length': 10}}})
+        statements = SchemaDiff(None, table).get_statements()
+        self.assertEqual(statements, [
+            ('CREATE TABLE "users" ("id" integer PRIMARY KEY, "name" varchar(10) DEFAULT %s)', ['']),
+        ])
+
+    def test_unchanged_table_has_no_statements(self):
+        table = build_table({'id': ID_FIELD})
+        self.assertFalse(SchemaDiff(table, build_table({'id': ID_FIELD})).has_changes())
+
+    def test_columns_are_added_dropped_and_altered_in_one_statement(self):
+        old = build_table({
+            'id': ID_FIELD,
+            'name': {'type': 'CharField', 'params': {'length': 10}},
+            'active': {'type': 'BooleanField', 'params': {}},
+        })
+        new = build_table({
+            'id': ID_FIELD,
+            'name': {'type': 'CharField', 'params': {'length': 20, 'nullable': False}},
+            'email': {'type': 'CharField', 'params': {'default_value': 'none'}},
+        })
+        statements = SchemaDiff(old, new).get_statements()
+        self.assertEqual(statements, [(
+            'ALTER TABLE "users" DROP COLUMN "active", '
+            'ADD COLUMN "email" varchar(255) DEFAULT %s, '
+            'ALTER COLUMN "name" TYPE varchar(20), '
+            'ALTER COLUMN "name" SET NOT NULL',
+            ['none'],
+        )])
+
+    def test_shrinking_varchar_is_not_cast(self):
+        # an explicit cast would truncate values silently, without it postgres refuses long values
+        old = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'length': 20}}})
+        new = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'length': 5}}})
+        [(sql, params)] = SchemaDiff(old, new).get_statements()
+        self.assertEqual(sql, 'ALTER TABLE "users" ALTER COLUMN "name" TYPE varchar(5)')
+
+    def test_other_types_are_cast(self):
+        old = build_table({'id': ID_FIELD, 'flag': {'type': 'BooleanField', 'params': {}}})
+        new = build_table({'id': ID_FIELD, 'flag': {'type': 'CharField', 'params': {'length': 5}}})
+        [(sql, params)] = SchemaDiff(old, new).get_statements()
+        self.assertIn('ALTER COLUMN "flag" TYPE varchar(5) USING "flag"::text', sql)
+
+
+class TableNameTests(SimpleTestCase):
+    def test_valid_names(self):
+        table_data = UserDatabaseHelper.build_table_from_data({
+            'name': 'users', 'fields': {'id': ID_FIELD, 'first_name': {'type': 'CharField', 'params': {}}},
+        })
+        self.assertEqual(table_data.get_name(), 'users')
+
+    def test_names_models_py_can_not_hold_are_rejected(self):
+        for name in ('none', 'true', '1users', 'users-1'):
+            with self.subTest(name=name), self.assertRaises(TableDataError):
+                UserDatabaseHelper.build_table_from_data({'name': name, 'fields': {'id': ID_FIELD}})
+        for field in ('class', 'pk', 'objects', 'first__name', 'name_'):
+            with self.subTest(field=field), self.assertRaises(TableDataError):
+                UserDatabaseHelper.build_table_from_data({'name': 'users', 'fields': {field: ID_FIELD}})
+
+
+class UserModelsFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.models_file = os.path.join(directory.name, 'models.py')
+
+    def test_new_file_is_readable_by_everyone(self):
+        self.assertTrue(UserDatabaseHelper.write_to_user_models_file('a', self.models_file))
+        self.assertEqual(UserDatabaseHelper.read_file(self.models_file), 'a')
+        self.assertEqual(stat.S_IMODE(os.stat(self.models_file).st_mode), 0o644)
+        self.assertEqual(os.listdir(self.directory), ['models.py'])
+
+    def test_unchanged_content_is_not_written(self):
+        UserDatabaseHelper.write_to_user_models_file('a', self.models_file)
+        inode = os.stat(self.models_file).st_ino
+        self.assertFalse(UserDatabaseHelper.write_to_user_models_file('a', self.models_file))
+        self.assertEqual(os.stat(self.models_file).st_ino, inode)
+
+    def test_mode_of_the_previous_file_is_kept(self):
+        UserDatabaseHelper.write_to_user_models_file('a', self.models_file)
+        os.chmod(self.models_file, 0o640)
+        self.assertTrue(UserDatabaseHelper.write_to_user_models_file('b', self.models_file))
+        self.assertEqual(UserDatabaseHelper.read_file(self.models_file), 'b')
+        self.assertEqual(stat.S_IMODE(os.stat(self.models_file).st_mode), 0o640)
+
+    def test_failed_write_leaves_the_file_alone(self):
+        UserDatabaseHelper.write_to_user_models_file('a', self.models_file)
+        with mock.patch('api.helpers.os.replace', side_effect=OSError('full')), self.assertRaises(OSError):
+            UserDatabaseHelper.write_to_user_models_file('b', self.models_file)
+        self.assertEqual(UserDatabaseHelper.read_file(self.models_file), 'a')
+        self.assertEqual(os.listdir(self.directory), ['models.py'])
+
+
+class FoldIdentifierTests(SimpleTestCase):
+    def test_unquoted_names_are_folded_to_lower_case(self):
+        self.assertEqual(UtilHelper.fold_identifier('Users'), 'users')
+        self.assertEqual(UtilHelper.fold_identifier('ÜSERS'), 'Üsers')
+
+    def test_quoted_names_are_kept(self):
+        self.assertEqual(UtilHelper.fold_identifier('"Users"'), 'Users')
+        self.assertEqual(UtilHelper.fold_identifier('"a""b"'), 'a"b')
+        self.assertEqual(UtilHelper.fold_identifier('"'), '"')
+
+
+class CatalogCacheTests(SimpleTestCase):
+    def setUp(self):
+        CatalogCache._local.clear()
+        caches['default'].clear()
+        self.load = mock.Mock(return_value=['users'])
+
+    def test_snapshot_is_loaded_once_until_invalidated(self):
+        self.assertEqual(CatalogCache.get_tables('tenant_a', self.load), frozenset(['users']))
+        CatalogCache.get_tables('tenant_a', self.load)
+        self.assertEqual(self.load.call_count, 1)
+        CatalogCache.invalidate('tenant_a')
+        CatalogCache.get_tables('tenant_a', self.load)
+        self.assertEqual(self.load.call_count, 2)
+
+    @mock.patch('api.cache.RESULT_CACHE_VERSION_BACKEND', 'default')
+    def test_schema_change_of_another_process_drops_the_snapshot(self):
+        CatalogCache.get_tables('tenant_a', self.load)
+        CatalogCache.get_tables('tenant_a', self.load)
+        self.assertEqual(self.load.call_count, 1)
+        # what CatalogCache.invalidate leaves behind in the shared cache
+        TableVersions.bump('tenant_a', CATALOG)
+        self.load.return_value = ['users', 'orders']
+        self.assertEqual(CatalogCache.get_tables('tenant_a', self.load), frozenset(['users', 'orders']))
+
+
+class RowReaderTests(SimpleTestCase):
+    def test_format_from_content_type(self):
+        self.assertEqual(RowReader.get_format('text/csv; charset=utf-8'), ROW_FORMAT_CSV)
+        self.assertEqual(RowReader.get_format('application/json', ROW_FORMAT_NDJSON), ROW_FORMAT_NDJSON)
+        with self.assertRaises(RowFormatError):
+            RowReader.get_format('text/plain')
+
+    def test_ndjson_rows_and_errors(self):
+        stream = io.BytesIO(b'{"id": 1}\n\nnot json\n[1]\n')
+        rows = list(RowReader.read(stream, ROW_FORMAT_NDJSON))
+        self.assertEqual(rows[0], ({'id': 1}, None))
+        self.assertIsNone(rows[1][0])
+        self.assertTrue(rows[1][1].startswith('invalid json'))
+        self.assertEqual(rows[2], (None, 'row must be an object'))
+
+    def test_csv_rows(self):
+        stream = io.BytesIO(b'id,name\n1,a\n2\n')
+        rows = list(RowReader.read(stream, ROW_FORMAT_CSV))
+        self.assertEqual(rows, [({'id': '1', 'name': 'a'}, None), (None, 'expected 2 values, got 1')])
+
+    def test_json_must_be_an_array(self):
+        with self.assertRaises(RowFormatError):
+            list(RowReader.read(io.BytesIO(b'{"id": 1}'), ROW_FORMAT_JSON))
+
+
+class BulkRowLoaderTests(SimpleTestCase):
+    def setUp(self):
+        self.loader = BulkRowLoader(build_table({
+            'id': ID_FIELD,
+            'name': {'type': 'CharField', 'params': {'length': 3, 'default_value': 'x'}},
+            'active': {'type': 'BooleanField', 'params': {}},
+        }))
+
+    def test_values_are_cleaned_in_field_order(self):
+        self.assertEqual(self.loader.clean_row({'id': '7', 'active': 'true'}), [True, 7, 'x'])
+
+    def test_invalid_rows_raise(self):
+        for row in ({'id': 1, 'other': 1}, {'id': 'a'}, {'id': 1, 'name': 'long'}, {'id': None}):
+            with self.subTest(row=row), self.assertRaises(ValueError):
+                self.loader.clean_row(row)
+
+
+class RowQueryTests(SimpleTestCase):
+    def setUp(self):
+        self.query = RowQuery(build_table({
+            'id': ID_FIELD,
+            'name': {'type': 'CharField', 'params': {'nullable': False}},
+            'note': {'type': 'CharField', 'params': {}},
+        }))
+
+    def test_cursor_round_trip(self):
+        cursor = RowQuery.encode_cursor('name', True, ['a', 1])
+        self.assertNotIn('=', cursor)
+        self.assertEqual(RowQuery.decode_cursor(cursor), ('name', True, ['a', 1]))
+
+    def test_invalid_cursor(self):
+        for cursor in ('!!', 'e30', RowQuery.encode_cursor('name', False, ['a'])):
+            with self.subTest(cursor=cursor), self.assertRaises(RowQueryError) as context:
+                self.query.page(10, cursor=cursor)
+            self.assertEqual(context.exception.param, 'cursor')
+
+    def test_page_after_cursor(self):
+        page = self.query.page(10, cursor=RowQuery.encode_cursor('name', False, ['a', 1]))
+        sql, params = page.build_select()
+        self.assertEqual(sql, 'SELECT "id", "name", "note" FROM "users" WHERE ("name", "id") > (%s, %s) '
+                              'ORDER BY "name" ASC, "id" ASC LIMIT %s')
+        self.assertEqual(params, ['a', 1, 11])
+
+    def test_next_cursor(self):
+        page = self.query.page(1, order_by='name')
+        result = page.build_result([(1, 'a', None), (2, 'b', None)])
+        self.assertEqual(result['rows'], [{'id': 1, 'name': 'a', 'note': None}])
+        self.assertEqual(RowQuery.decode_cursor(result['next_cursor']), ('name', False, ['a', 1]))
+
+    def test_nullable_columns_can_not_be_ordered_by(self):
+        with self.assertRaises(RowQueryError) as context:
+            self.query.page(10, order_by='note')
+        self.assertEqual(context.exception.param, 'order_by')
+
+
+@mock.patch('api.cache.RESULT_CACHE_VERSION_BACKEND', 'default')
+class QueryResultCacheTests(SimpleTestCase):
+    sql = 'SELECT "id" FROM "users"'
+
+    def setUp(self):
+        QueryResultCache._local.clear()
+        caches['default'].clear()
+        self.load = mock.Mock(return_value=[(1,)])
+
+    def read(self, table='users', database='tenant_a'):
+        return QueryResultCache.get_or_load(database, table, self.sql, [], self.load)
+
+    def test_results_are_served_until_the_table_changes(self):
+        self.assertEqual(self.read(), [(1,)])
+        self.read()
+        self.assertEqual(self.load.call_count, 1)
+        QueryResultCache.invalidate('tenant_a', 'users')
+        self.load.return_value = [(2,)]
+        self.assertEqual(self.read(), [(2,)])
+
+    def test_changes_are_scoped_to_the_table_and_database(self):
+        self.read()
+        self.read(table='orders')
+        self.read(database='tenant_b')
+        QueryResultCache.invalidate('tenant_a', 'orders')
+        self.read()
+        self.read(database='tenant_b')
+        self.assertEqual(self.load.call_count, 3)
+        self.read(table='orders')
+        self.assertEqual(self.load.call_count, 4)
+
+    def test_database_wide_changes_drop_every_table(self):
+        self.read()
+        self.read(table='orders')
+        QueryResultCache.invalidate('tenant_a')
+        self.read()
+        self.read(table='orders')
+        self.assertEqual(self.load.call_count, 4)
+
+    def test_lost_versions_never_match_old_results(self):
+        self.read()
+        QueryResultCache.invalidate('tenant_a', 'users')
+        # the shared cache was restarted, the versions are gone
+        caches['default'].clear()
+        self.read()
+        self.assertEqual(self.load.call_count, 2)
+
+    def test_disabled_without_a_shared_backend(self):
+        with mock.patch('api.cache.RESULT_CACHE_VERSION_BACKEND', None):
+            self.read()
+            self.read()
+        self.assertEqual(self.load.call_count, 2)
+
+    def test_only_reads_are_cached(self):
+        self.assertTrue(QueryResultCache.is_read(' select 1'))
+        self.assertFalse(QueryResultCache.is_read('UPDATE "users" SET "id" = 1'))
+
+
+class TableFingerprintTests(SimpleTestCase):
+    def test_fingerprint_ignores_order_and_defaults(self):
+        first = TableData.from_json(
+            '{"name": "users", "fields": {"id": {"type": "PrimaryKeyField", "params": {}}, '
+            '"name": {"type": "CharField", "params": {"nullable": true, "length": 255}}}}'
+        )
+        second = build_table({
+            'name': {'type': 'CharField', 'params': {'length': 255, 'default_value': ''}},
+            'id': ID_FIELD,
+        })
+        self.assertEqual(first.get_fingerprint(), second.get_fingerprint())
+        self.assertEqual(first, second)
+        self.assertEqual(len(first.get_fingerprint()), 64)
+
+    def test_fingerprint_changes_with_the_table(self):
+        table = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {}}})
+        changes = [
+            build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'length': 10}}}),
+            build_table({'id': ID_FIELD, 'name': {'type': 'BooleanField', 'params': {}}}),
+            build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {}}}, name='people'),
+            build_table({'id': ID_FIELD, 'title': {'type': 'CharField', 'params': {}}}),
+        ]
+        for changed in changes:
+            with self.subTest(changed=changed):
+                self.assertNotEqual(table.get_fingerprint(), changed.get_fingerprint())
+
+    def test_fingerprint_survives_a_json_round_trip(self):
+        table = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'nullable': False}}})
+        self.assertEqual(TableData.from_json(table.to_json()).get_fingerprint(), table.get_fingerprint())
+
+
+class TableDataImmutabilityTests(SimpleTestCase):
+    def setUp(self):
+        TableDataCache._local.clear()
+        self.table = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'index': True}}})
+
+    def test_tables_fields_and_indexes_can_not_be_changed(self):
+        [index] = self.table.get_indexes()
+        for target, attribute in ((self.table, 'name'), (self.table.get_fields()[1], 'length'), (index, 'unique')):
+            with self.subTest(target=target), self.assertRaises(AttributeError):
+                setattr(target, attribute, None)
+        with self.assertRaises(AttributeError):
+            self.table.extra = 1
+        self.assertIsInstance(self.table.get_fields(), tuple)
+
+    def test_fingerprint_is_computed_once(self):
+        with mock.patch('api.helpers.UtilHelper.get_fingerprint', return_value='f') as get_fingerprint:
+            self.assertEqual(self.table.get_fingerprint(), 'f')
+            self.assertEqual(self.table.get_fingerprint(), 'f')
+        get_fingerprint.assert_called_once()
+
+    def test_parsed_tables_are_cached_by_fingerprint(self):
+        load = mock.Mock(return_value=self.table)
+        fingerprint = self.table.get_fingerprint()
+        self.assertIs(TableDataCache.get('tenant_a', 'users', fingerprint, load), self.table)
+        self.assertIs(TableDataCache.get('tenant_a', 'users', fingerprint, load), self.table)
+        self.assertEqual(load.call_count, 1)
+        TableDataCache.get('tenant_a', 'users', None, load)
+        self.assertEqual(load.call_count, 2)
+
+
+class TableIndexTests(SimpleTestCase):
+    def test_index_changes(self):
+        old = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'index': True}}})
+        new = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'unique': True}}})
+        dropped, created = SchemaDiff(old, new).get_index_changes()
+        self.assertEqual([(index.fields, index.unique) for index in dropped], [(('name',), False)])
+        self.assertEqual([(index.fields, index.unique) for index in created], [(('name',), True)])
+        self.assertEqual(SchemaDiff(old, new).get_statements(), [])
+
+    def test_unique_checks_use_defaults_of_added_columns(self):
+        old = build_table({'id': ID_FIELD})
+        new = build_table({'id': ID_FIELD, 'code': {'type': 'CharField', 'params': {'unique': True}}})
+        [(index, sql, params)] = SchemaDiff(old, new).get_unique_checks()
+        self.assertTrue(index.unique)
+        self.assertIn('%s::varchar(255) AS c0', sql)
+        self.assertEqual(params, [''])
+
+    def test_new_tables_need_no_unique_checks(self):
+        new = build_table({'id': ID_FIELD, 'code': {'type': 'CharField', 'params': {'unique': True}}})
+        self.assertEqual(SchemaDiff(None, new).get_unique_checks(), [])
+
+    def test_table_level_indexes(self):
+        table = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'index': True}}},
+                            indexes=[{'fields': ['name', 'id'], 'unique': True}])
+        indexes = table.get_indexes()
+        self.assertEqual([(index.fields, index.unique) for index in indexes],
+                         [(('name',), False), (('name', 'id'), True)])
+        self.assertTrue(all(len(index.name) <= 30 for index in indexes))
+        self.assertEqual(indexes[1].build_create(), 'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS '
+                                                    f'"{indexes[1].name}" ON "users" ("name", "id")')
+
+    def test_invalid_indexes_are_rejected(self):
+        fields = {'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {}}}
+        for indexes in ({}, [{}], [{'fields': []}], [{'fields': ['other']}], [{'fields': ['name', 'name']}]):
+            with self.subTest(indexes=indexes), self.assertRaises(TableDataError):
+                UserDatabaseHelper.validate_indexes({'name': 'users', 'fields': fields, 'indexes': indexes})
+
+    def test_failed_indexes_are_left_out(self):
+        table = build_table({'id': ID_FIELD, 'name': {'type': 'CharField', 'params': {'unique': True, 'length': 5}}},
+                            indexes=[{'fields': ['name', 'id']}])
+        column_index, table_index = table.get_indexes()
+        without_column_index = table.without_indexes({column_index.name})
+        self.assertEqual(without_column_index.get_indexes(), [table_index])
+        self.assertEqual(without_column_index.get_fields()[1].length, 5)
+        self.assertEqual(table.without_indexes({column_index.name, table_index.name}).get_indexes(), [])
+        self.assertEqual(table.without_indexes(set()), table)
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        Metrics.clear()
+
+    def tearDown(self):
+        Metrics.clear()
+
+    def test_render(self):
+        Metrics.record_request('tenant_a', 'GET', 200, 0.02)
+        with Metrics.time_query('tenant_a', 'users') as record:
+            record.rows = 3
+        content = Metrics.render({'tenant_a': {'size': 3, 'idle': 1}})
+        self.assertIn('# TYPE api_request_duration_seconds histogram', content)
+        self.assertIn('api_request_duration_seconds_bucket{tenant="tenant_a",method="GET",status="200",le="0.025"} 1',
+                      content)
+        self.assertIn('api_request_duration_seconds_count{tenant="tenant_a",method="GET",status="200"} 1', content)
+        self.assertIn('api_query_rows_total{tenant="tenant_a",table="users"} 3', content)
+        self.assertIn('api_pool_connections{database="tenant_a",state="in_use"} 2', content)
+        self.assertTrue(content.endswith('\n'))
+
+    def test_labels_are_escaped(self):
+        Metrics.inc(Metrics.QUERY_ERRORS, ('a"b', 'c\\d'))
+        self.assertIn('api_query_errors_total{tenant="a\\"b",table="c\\\\d"} 1', Metrics.render())
+
+
+class SchemaJobQueueTests(TestCase):
+    def create_job(self, *tables, database='tenant_a'):
+        return SchemaJob.objects.create(database=database, payload={'tables': list(tables)})
+
+    def test_queued_jobs_are_merged(self):
+        first = self.create_job({'name': 'a', 'fields': {'x': 1}}, {'name': 'b', 'fields': {}})
+        second = self.create_job({'name': 'a', 'fields': {'x': 2}})
+        other = self.create_job({'name': 'c', 'fields': {}}, database='tenant_b')
+        with mock.patch.object(SchemaJobQueue, '_apply') as apply:
+            self.assertTrue(SchemaJobQueue._run_queued('tenant_a'))
+            self.assertFalse(SchemaJobQueue._run_queued('tenant_a'))
+        apply.assert_called_once_with([{'name': 'a', 'fields': {'x': 2}}, {'name': 'b', 'fields': {}}])
+        for job in (first, second):
+            job.refresh_from_db()
+            self.assertEqual(job.status, SchemaJob.STATUS_SUCCEEDED)
+        other.refresh_from_db()
+        self.assertEqual(other.status, SchemaJob.STATUS_QUEUED)
+
+    def test_failed_batch_is_retried_job_by_job(self):
+        good = self.create_job({'name': 'a', 'fields': {}})
+        bad = self.create_job({'name': 'b', 'fields': {}})
+
+        def apply(tables):
+            if any(table['name'] == 'b' for table in tables):
+                raise ValueError('broken')
+
+        with mock.patch.object(SchemaJobQueue, '_apply', side_effect=apply):
+            SchemaJobQueue._run_queued('tenant_a')
+        good.refresh_from_db()
+        bad.refresh_from_db()
+        self.assertEqual(good.status, SchemaJob.STATUS_SUCCEEDED)
+        self.assertEqual((bad.status, bad.error), (SchemaJob.STATUS_FAILED, 'broken'))
+
+    def test_running_jobs_are_requeued(self):
+        job = self.create_job({'name': 'a', 'fields': {}})
+        SchemaJob.objects.filter(pk=job.pk).update(status=SchemaJob.STATUS_RUNNING)
+        SchemaJobQueue._requeue_running('tenant_a')
+        job.refresh_from_db()
+        self.assertEqual(job.status, SchemaJob.STATUS_QUEUED)
+
+    def test_batch_is_not_replayed_after_its_indexes_failed(self):
+        first = self.create_job({'name': 'a', 'fields': {}})
+        second = self.create_job({'name': 'b', 'fields': {}})
+        with mock.patch.object(SchemaJobQueue, '_apply', side_effect=IndexBuildError('indexes failed')) as apply:
+            SchemaJobQueue._run_queued('tenant_a')
+        apply.assert_called_once()
+        for job in (first, second):
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.error), (SchemaJob.STATUS_FAILED, 'indexes failed'))
+
+    def test_tables_redefined_later_in_a_failed_batch_are_left_to_the_later_job(self):
+        first = self.create_job({'name': 'a', 'fields': {'x': 1}}, {'name': 'b', 'fields': {}})
+        second = self.create_job({'name': 'a', 'fields': {'x': 2}})
+        applied = []
+
+        def apply(tables):
+            applied.append(tables)
+            if {'name': 'a', 'fields': {'x': 2}} in tables:
+                raise ValueError('broken')
+
+        with mock.patch.object(SchemaJobQueue, '_apply', side_effect=apply):
+            SchemaJobQueue._run_queued('tenant_a')
+        self.assertEqual(applied[1:], [[{'name': 'b', 'fields': {}}], [{'name': 'a', 'fields': {'x': 2}}]])
+        for job in (first, second):
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.error), (SchemaJob.STATUS_FAILED, 'broken'))
+
+
+class TenantSchemaLockTests(SimpleTestCase):
+    def test_keys_are_signed_64_bit_integers(self):
+        keys = {TenantSchemaLock.get_key(f'tenant_{i}') for i in range(1000)}
+        self.assertEqual(len(keys), 1000)
+        self.assertTrue(all(-2 ** 63 <= key < 2 ** 63 for key in keys))
+        self.assertTrue(any(key >= 2 ** 31 or key < -2 ** 31 for key in keys))
+        self.assertEqual(TenantSchemaLock.get_key('tenant_1'), TenantSchemaLock.get_key('tenant_1'))
+
+    @mock.patch.object(SchemaJobQueue, '_has_queued', return_value=False)
+    @mock.patch.object(SchemaJobQueue, '_run_queued', return_value=False)
+    @mock.patch.object(SchemaJobQueue, '_requeue_running')
+    @mock.patch.object(TenantSchemaLock, 'release')
+    def test_jobs_are_left_to_the_lock_holder(self, release, requeue_running, run_queued, has_queued):
+        with mock.patch.object(TenantSchemaLock, 'acquire', return_value=False):
+            SchemaJobQueue._run('tenant_a', None)
+        run_queued.assert_not_called()
+        with mock.patch.object(TenantSchemaLock, 'acquire', return_value=True):
+            SchemaJobQueue._run('tenant_a', None)
+        requeue_running.assert_called_once_with('tenant_a')
+        release.assert_called_once_with('tenant_a')
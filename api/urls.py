@@ -1,8 +1,17 @@
 from django.urls import path
 
-from api.views import create_table, table_exists
+from api.views import create_table, table_exists, schema_job, create_schema, insert_rows, \
+    read_rows
+from app.settings import API_ASYNC_VIEWS
+
+if API_ASYNC_VIEWS:
+    from api.async_views import table_exists, read_rows
 
 urlpatterns = [
     path('create-table', create_table),
     path('table-exists', table_exists),
+    path('schema', create_schema),
+    path('schema-jobs/<uuid:job_id>', schema_job),
+    path('tables/<str:name>/rows', read_rows),
+    path('tables/<str:name>/rows:bulk', insert_rows),
 ]
\ No newline at end of file
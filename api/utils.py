@@ -1,3 +1,5 @@
+import hashlib
+import json
 import random
 import string
 
@@ -7,3 +9,23 @@ class UtilHelper:
     def get_random_string(length):
         result_str = ''.join(random.choice(string.ascii_letters) for i in range(length))
         return result_str
+
+    @staticmethod
+    def quote_identifier(name):
+        return '"%s"' % name.replace('"', '""')
+
+    @staticmethod
+    def fold_identifier(name):
+        """
+        the name postgres looks up for an identifier written in a query,
+        unquoted ones are folded to lower case
+        """
+        if len(name) > 1 and name.startswith('"') and name.endswith('"'):
+            return name[1:-1].replace('""', '"')
+        return ''.join(char.lower() if char.isascii() else char for char in name)
+
+    @staticmethod
+    def get_fingerprint(data):
+        if not isinstance(data, str):
+            data = json.dumps(data, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
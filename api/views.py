@@ -1,34 +1,75 @@
-import traceback
+import hmac
+import math
 
+import psycopg2
+from django.http import StreamingHttpResponse, HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+from rest_framework import status
 from rest_framework.decorators import api_view
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.response import Response
 
-from api.helpers import dbname, fetchone, DbHelper
+from api.helpers import dbname, DbHelper
+from api.jobs import SchemaJobQueue
+from api.metrics import Metrics
+from api.middleware import get_user_database
+from api.queries import RowQuery, RowQueryError
+from api.rows import RowReader, RowWriter, RowFormatError, ROW_FORMAT_NDJSON, ROW_FORMAT_CSV
+from api.pool import connection_pool
+from app.settings import SCHEMA_JOB_MAX_WAIT, ROW_EXPORT_FETCH_SIZE, ROW_EXPORT_MAX_FETCH_SIZE, \
+    ROW_PAGE_DEFAULT_LIMIT, ROW_PAGE_MAX_LIMIT, METRICS_ENABLED, METRICS_TOKEN
 
 
 @api_view(['post'])
 def create_table(request):
     name = request.data.get("name", None)
     fields = request.data.get("fields", None)
+    indexes = request.data.get("indexes", None)
     if not name or not fields:
         raise ValidationError({'non_fields_errors': {'name': 'please provide name and fields'}})
+    table = {'name': name, 'fields': fields}
+    if indexes is not None:
+        table['indexes'] = indexes
+    # noinspection PyBroadException
     try:
-        DbHelper.create_table(name, fields)
+        DbHelper.build_table_from_data(table)
     except Exception as e:
-        from pprint import pprint
-        print('')
-        print('PPRINT')
-        print('')
-        print('')
-        print('')
-        pprint(str(e))
-        pprint(traceback.format_exc())
-        print('')
-        print('')
-        print('')
-        raise ValidationError({'non_field_errors': {'name': "Can't create table"}})
-    return Response("implement this method")
+        raise ValidationError({'non_field_errors': {'name': "Can't create table: %s" % e}})
+    job = SchemaJobQueue.submit([table])
+    return Response(job.to_dict(), status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['post'])
+def create_schema(request):
+    tables = request.data.get('tables', None)
+    if not tables or not isinstance(tables, list):
+        raise ValidationError({'non_field_errors': {'tables': 'please provide a list of tables'}})
+    # noinspection PyBroadException
+    try:
+        DbHelper.build_tables_from_data(tables)
+    except Exception as e:
+        raise ValidationError({'non_field_errors': {'tables': "Can't create tables: %s" % e}})
+    job = SchemaJobQueue.submit(tables)
+    return Response(job.to_dict(), status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['get'])
+def schema_job(request, job_id):
+    wait = request.query_params.get('wait', None)
+    database = get_user_database()
+    if wait:
+        try:
+            timeout = float(wait)
+        except ValueError:
+            timeout = None
+        if timeout is None or not math.isfinite(timeout) or timeout < 0:
+            raise ValidationError({'non_field_errors': {'wait': 'wait must be a number of seconds'}})
+        timeout = min(timeout, SCHEMA_JOB_MAX_WAIT)
+        job = SchemaJobQueue.wait(job_id, database, timeout)
+    else:
+        job = SchemaJobQueue.get(job_id, database)
+    if job is None:
+        raise NotFound()
+    return Response(job.to_dict())
 
 
 @api_view(['get'])
@@ -36,10 +77,104 @@ def table_exists(request):
     name = request.query_params.get('name', None)
     if not name:
         raise ValidationError({'non_field_errors': {'name': 'please provide table name'}})
-    # noinspection PyBroadException
+    return Response(DbHelper.table_exists(name))
+
+
+@api_view(['post'])
+def insert_rows(request, name):
+    table_data = DbHelper.get_table_data(name)
+    if table_data is None:
+        raise NotFound()
     try:
-        # noinspection SqlDialectInspection
-        data = fetchone('select * from %s' % name)
-        return Response(True)
-    except Exception as e:
-        return Response(False)
+        row_format = RowReader.get_format(request.content_type, request.query_params.get('row_format', None))
+        rows = RowReader.read(request.stream, row_format)
+        result = DbHelper.insert_rows(table_data, rows)
+    except RowFormatError as e:
+        raise ValidationError({'non_field_errors': {'rows': str(e)}})
+    except psycopg2.Error as e:
+        raise ValidationError({'non_field_errors': {'rows': "Can't insert rows: %s" % e}})
+    return Response(result)
+
+
+@api_view(['get'])
+def read_rows(request, name):
+    """
+    with ?limit= or ?cursor= one page of rows is returned as json, ordered by
+    ?order_by= (primary key by default) and ?order=asc|desc.
+    Otherwise all rows are streamed as ndjson or csv (?row_format=).
+    ?columns=a,b selects columns in both cases.
+    """
+    table_data = DbHelper.get_table_data(name)
+    if table_data is None:
+        raise NotFound()
+    query = build_row_query(table_data, request.query_params)
+    if is_page_request(request.query_params):
+        page = build_row_page(query, request.query_params)
+        sql, params = page.build_select()
+        rows = DbHelper.fetchall_cached(table_data.get_name(), sql, params)
+        return Response(page.build_result(rows))
+    content, content_type = build_row_export(table_data, query, request.query_params)
+    return StreamingHttpResponse(content, content_type=content_type)
+
+
+def build_row_query(table_data, query_params):
+    columns = query_params.get('columns', None)
+    try:
+        return RowQuery(table_data, columns.split(',') if columns else None)
+    except RowQueryError as e:
+        raise ValidationError({'non_field_errors': {'columns': str(e)}})
+
+
+def build_row_export(table_data, query, query_params):
+    """
+    returns the export content and its content type, rows are read while the
+    content is iterated
+    """
+    row_format = query_params.get('row_format', ROW_FORMAT_NDJSON)
+    if row_format not in (ROW_FORMAT_NDJSON, ROW_FORMAT_CSV):
+        raise ValidationError({'non_field_errors': {'row_format': 'row_format must be ndjson or csv'}})
+    fetch_size = get_int_query_param(query_params, 'fetch_size', ROW_EXPORT_FETCH_SIZE, ROW_EXPORT_MAX_FETCH_SIZE)
+    sql, params = query.build_select()
+    rows = DbHelper.iter_rows(sql, params, fetch_size, table_data.get_name())
+    return RowWriter.write(query.get_columns(), rows, row_format, fetch_size), RowWriter.get_content_type(row_format)
+
+
+def is_page_request(query_params):
+    return 'limit' in query_params or 'cursor' in query_params
+
+
+def build_row_page(query, query_params):
+    limit = get_int_query_param(query_params, 'limit', ROW_PAGE_DEFAULT_LIMIT, ROW_PAGE_MAX_LIMIT)
+    order = query_params.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValidationError({'non_field_errors': {'order': 'order must be asc or desc'}})
+    try:
+        return query.page(
+            limit,
+            order_by=query_params.get('order_by', None),
+            descending=order == 'desc',
+            cursor=query_params.get('cursor', None),
+        )
+    except RowQueryError as e:
+        raise ValidationError({'non_field_errors': {e.param or 'cursor': str(e)}})
+
+
+def get_int_query_param(query_params, name, default, maximum):
+    try:
+        value = int(query_params.get(name, default))
+    except ValueError:
+        raise ValidationError({'non_field_errors': {name: '%s must be a number' % name}})
+    return max(1, min(value, maximum))
+
+
+def metrics(request):
+    """
+    prometheus scrape endpoint, a plain django view so content negotiation
+    does not get in the way of the text format
+    """
+    if not METRICS_ENABLED or not METRICS_TOKEN:
+        return HttpResponseNotFound()
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+        return HttpResponseForbidden()
+    return HttpResponse(Metrics.render(connection_pool.stats()), content_type='text/plain; version=0.0.4')
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FrontendDatabase.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+# serve table-exists and paged row reads from async views (see api/async_views.py)
+os.environ.setdefault('API_ASYNC_VIEWS', '1')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from api.asgi import APIASGIHandler  # noqa: E402
+
+# ASGIHandler that streams the row exports of the async views off the event loop
+application = APIASGIHandler()
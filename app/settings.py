@@ -99,6 +99,135 @@ DATABASES = {
     }
 }
 
+# 'database' gives every tenant its own database, 'schema' gives every tenant
+# a schema inside TENANT_SHARED_DATABASE and lets them share one connection pool
+# (see api/tenancy.py). Existing tenants are not moved when the mode changes.
+
+TENANT_STORAGE_MODE = os.environ.get('TENANT_STORAGE_MODE', 'database')
+TENANT_SHARED_DATABASE = os.environ.get('TENANT_SHARED_DATABASE', 'frontend_database_tenants')
+
+# Spare tenant databases cloned from TENANT_TEMPLATE_DATABASE ahead of signups
+# (see api/provisioning.py). A background thread keeps TENANT_SPARE_DATABASES
+# of them ready, `manage.py fill_spare_databases` does the same from a deploy
+# step or cron. Not used in schema mode, a schema is cheap to create.
+
+TENANT_TEMPLATE_DATABASE = os.environ.get('TENANT_TEMPLATE_DATABASE', 'frontend_database_template')
+TENANT_SPARE_DATABASES = 5
+TENANT_SPARE_FILL_INTERVAL = 60
+
+# Tenant databases get a connection alias on first use (see api/routers.py),
+# aliases unused for TENANT_CONNECTION_IDLE_TIMEOUT seconds are closed and removed.
+
+DATABASE_ROUTERS = ['api.routers.TenantDatabaseRouter']
+
+TENANT_CONNECTION_IDLE_TIMEOUT = 300
+TENANT_CONNECTION_SWEEP_INTERVAL = 60
+
+# Tenant database connection pool (see api/pool.py)
+
+USER_DATABASE_POOL_MAX_SIZE = 5
+USER_DATABASE_POOL_MAX_TOTAL = 100
+USER_DATABASE_POOL_IDLE_TIMEOUT = 300
+USER_DATABASE_POOL_CHECKOUT_TIMEOUT = 10
+USER_DATABASE_POOL_HEALTH_CHECK_INTERVAL = 30
+
+# Token -> database lookups in APIMiddleware (see api/cache.py).
+# TOKEN_CACHE_BACKEND is an optional alias from CACHES shared between workers that
+# replaces the in-process cache. Without it other worker processes notice changed
+# or deleted tokens only after TOKEN_CACHE_TTL seconds.
+
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_BACKEND = None
+
+# How table changes reach tenant databases: 'ddl' applies the difference
+# directly (see api/schema.py), 'migrations' runs makemigrations/migrate.
+
+USER_SCHEMA_BACKEND = 'ddl'
+
+# Generated model classes kept in memory while rebuilding models.py files
+
+MODEL_SOURCE_CACHE_SIZE = 10000
+
+# Parsed table definitions keyed by (database, table, fingerprint)
+
+TABLE_DATA_CACHE_SIZE = 10000
+
+# Table names of tenant databases answering table-exists. Schema changes drop the
+# snapshot at once in every process sharing RESULT_CACHE_VERSION_BACKEND, without
+# it other processes see them after CATALOG_CACHE_TTL seconds.
+
+CATALOG_CACHE_SIZE = 10000
+CATALOG_CACHE_TTL = 60
+
+# Background schema changes (see api/jobs.py)
+
+SCHEMA_JOB_WORKERS = 4
+SCHEMA_JOB_POLL_INTERVAL = 0.2
+SCHEMA_JOB_MAX_WAIT = 30
+# schema changes a tenant submits within this many seconds are applied together
+SCHEMA_JOB_DEBOUNCE = 0.1
+SCHEMA_BATCH_MAX_TABLES = 500
+
+# Tenant apps under __apps__ are installed on their first request, at most
+# TENANT_APPS_MAX_LOADED at a time. Set TENANT_APPS_EAGER_LOAD=1 for management
+# commands that work on tenant apps (makemigrations, migrate).
+
+TENANT_APPS_MAX_LOADED = 1000
+TENANT_APPS_EAGER_LOAD = os.environ.get('TENANT_APPS_EAGER_LOAD') == '1'
+
+# Bulk row ingestion (see api/rows.py)
+
+BULK_INSERT_CHUNK_SIZE = 5000
+BULK_INSERT_MAX_ERRORS = 100
+
+# Row export through server side cursors, rows fetched per round trip
+
+ROW_EXPORT_FETCH_SIZE = 2000
+ROW_EXPORT_MAX_FETCH_SIZE = 50000
+
+# Keyset paginated row reads
+
+ROW_PAGE_DEFAULT_LIMIT = 100
+ROW_PAGE_MAX_LIMIT = 1000
+
+# Cached results of paged row reads. Table versions decide whether a cached
+# result is still valid, they are kept in the RESULT_CACHE_VERSION_BACKEND
+# cache shared by all worker processes. Results are not cached without it.
+
+RESULT_CACHE_MAX_ENTRIES = 10000
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_TTL = 300
+RESULT_CACHE_VERSION_BACKEND = None
+
+# Async views and connection pool for the hot read paths, enabled by app/asgi.py.
+# Needs psycopg 3 (pip install "psycopg[binary]"), startup fails without it.
+
+API_ASYNC_VIEWS = os.environ.get('API_ASYNC_VIEWS') == '1'
+
+# Request, query and connection pool metrics per tenant and table, served in the
+# Prometheus text format at GET /metrics (see api/metrics.py). The scraper sends
+# `Authorization: Bearer <METRICS_TOKEN>`, the endpoint is off without a token.
+
+METRICS_ENABLED = True
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_MAX_SERIES = 10000
+METRICS_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Opt-in request profiling (see api/profiling.py): phases of APIMiddleware and
+# their query counts in a Server-Timing header. REQUEST_PROFILE_SAMPLE_RATE of
+# the requests run under cProfile, stats of those slower than
+# REQUEST_PROFILE_SLOW_THRESHOLD seconds are dumped to REQUEST_PROFILE_DIR.
+
+REQUEST_PROFILING_ENABLED = os.environ.get('REQUEST_PROFILING_ENABLED') == '1'
+REQUEST_PROFILE_SAMPLE_RATE = float(os.environ.get('REQUEST_PROFILE_SAMPLE_RATE', '0'))
+REQUEST_PROFILE_SLOW_THRESHOLD = 0.5
+REQUEST_PROFILE_DIR = os.environ.get('REQUEST_PROFILE_DIR', str(BASE_DIR / 'profiles'))
+
+# Paths APIMiddleware lets through without a user token
+
+API_MIDDLEWARE_EXEMPT_PATHS = ('/metrics',)
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 